@@ -0,0 +1,128 @@
+from concurrent.futures import ProcessPoolExecutor
+from itertools import repeat
+from timing import span, tracer
+import numpy as np, multiprocessing, os, shutil, subprocess
+
+VIDEO_CODECS = {'.mp4': ['-c:v', 'libx264', '-pix_fmt', 'yuv420p'],
+                '.webm': ['-c:v', 'libvpx-vp9', '-pix_fmt', 'yuv420p']}
+
+
+def use_agg():
+    import matplotlib
+    matplotlib.use('Agg', force=True)
+
+
+def pool_context():
+    #Workers start from a clean process, forking after dask or HDF5 threads have run can deadlock
+    method = 'forkserver' if 'forkserver' in multiprocessing.get_all_start_methods() else 'spawn'
+    return multiprocessing.get_context(method)
+
+
+def start_worker(origin=None):
+    #perf_counter is one monotonic clock for every process, so with the parent's origin
+    #worker spans line up with the parent's in the trace
+    use_agg()
+    if origin is not None:
+        tracer.origin = origin
+        tracer.enable()
+
+
+def figure_to_rgba(fig):
+    '''
+    Render a figure with Agg and return its pixels as an (height, width, 4) uint8 array.
+    '''
+    import matplotlib.pyplot as plt
+    fig.canvas.draw()
+    frame = np.array(fig.canvas.buffer_rgba())
+    plt.close(fig)
+    return frame
+
+
+def render_frame(plotter, kwargs):
+    return figure_to_rgba(plotter(savefig=False, **kwargs))
+
+
+def render_worker_frame(plotter, kwargs):
+    #Runs in a worker process, its spans go back with the frame
+    return render_frame(plotter, kwargs), tracer.drain()
+
+
+def render_frames(plotter, frames, workers=None):
+    '''
+    Render frames in a process pool and yield them in order as RGBA arrays.
+    Parameters:
+    -----------
+    plotter - picklable callable returning a figure, called as plotter(savefig=False, **kwargs)
+    frames  - list of keyword dictionaries, one per frame
+    workers - number of processes, default is one per core, 1 renders in this process
+    '''
+    if workers == 1:
+        for index, kwargs in enumerate(frames):
+            with span('frame', index=index):
+                frame = render_frame(plotter, kwargs)
+            yield frame
+        return
+    #Frames go out in chunks to cut the number of round trips to the workers
+    chunksize = max(1, len(frames) // (4 * (workers or os.cpu_count())))
+    origin = tracer.origin if tracer.enabled else None
+    with ProcessPoolExecutor(max_workers=workers, initializer=start_worker, initargs=(origin,), mp_context=pool_context()) as pool:
+        results = pool.map(render_worker_frame, repeat(plotter), frames, chunksize=chunksize)
+        for index in range(len(frames)):
+            #Time spent waiting on the workers for each frame
+            with span('frame', index=index):
+                frame, events = next(results)
+            tracer.merge(events)
+            yield frame
+
+
+def write_gif(frames, path, duration=200, loop=0):
+    from PIL import Image
+    images = (Image.fromarray(frame) for frame in frames)
+    first = next(images)
+    first.save(path, format='GIF', append_images=images, save_all=True, duration=duration, loop=loop)
+
+
+def write_video(frames, path, duration=200):
+    '''
+    Pipe raw RGBA frames into a local ffmpeg, the codec follows the extension of path (.mp4 or .webm).
+    '''
+    ffmpeg = shutil.which('ffmpeg')
+    if ffmpeg is None:
+        raise RuntimeError('ffmpeg was not found, cannot write ' + path)
+    codec = VIDEO_CODECS[os.path.splitext(path)[1].lower()]
+
+    frames = iter(frames)
+    first = next(frames)
+    height, width = first.shape[:2]
+    command = [ffmpeg, '-y', '-loglevel', 'error', '-f', 'rawvideo', '-pix_fmt', 'rgba',
+               '-s', f'{width}x{height}', '-r', str(1000 / duration), '-i', '-',
+               '-vf', 'scale=trunc(iw/2)*2:trunc(ih/2)*2', *codec, path]
+    encoder = subprocess.Popen(command, stdin=subprocess.PIPE, stderr=subprocess.PIPE)
+    try:
+        encoder.stdin.write(first.tobytes())
+        for frame in frames:
+            encoder.stdin.write(frame.tobytes())
+        encoder.stdin.close()
+    except BrokenPipeError:
+        #ffmpeg exited early, the reason is in its error output
+        try:
+            encoder.stdin.close()
+        except BrokenPipeError:
+            pass
+    except BaseException:
+        encoder.kill()
+        encoder.wait()
+        raise
+    with encoder.stderr:
+        error = encoder.stderr.read().decode(errors='replace').strip()
+    encoder.wait()
+    if encoder.returncode != 0:
+        raise RuntimeError(f'ffmpeg failed writing {path}: {error}')
+
+
+def save_animation(frames, path, duration=200, loop=0):
+    with span('save_animation', path=path):
+        if os.path.splitext(path)[1].lower() in VIDEO_CODECS:
+            write_video(frames, path, duration)
+        else:
+            write_gif(frames, path, duration, loop)
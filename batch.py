@@ -0,0 +1,114 @@
+'''
+Headless batch rendering of Diana plots.
+
+    python batch.py spec.json [--workers N] [--force]
+
+The spec is a JSON object, or a list of them, for example
+    {"source": "latest.nc", "output": "plots/", "variables": ["air_temperature_2m"],
+     "timesteps": [0, 1, 2], "levels": [0], "projection": "LambertConformal",
+     "extent": [0, 30, 55, 75], "contour_levels": 10, "cmap": "coolwarm", "mode": "raster"}
+"timesteps" may be "all", "extent" may be left out to use the extent of the data,
+"mode" is "contour" (default) or "raster".
+'''
+from concurrent.futures import ProcessPoolExecutor
+from animation import pool_context, use_agg
+import argparse, hashlib, json, os, sys
+
+DEFAULTS = {'output': '.', 'timesteps': [0], 'levels': [0], 'projection': 'PlateCarree', 'extent': None,
+            'contour_levels': 10, 'cmap': 'coolwarm', 'size': [12, 8], 'dpi': 100, 'coastlines': True, 'mode': 'contour'}
+
+#Opened once per worker process and reused by every task it renders
+_loaders, _geometries = {}, {}
+
+
+def read_spec(path):
+    with open(path) as f:
+        spec = json.load(f)
+    specs = spec if isinstance(spec, list) else [spec]
+    return [dict(DEFAULTS, **spec) for spec in specs]
+
+
+def make_tasks(spec, force=False):
+    '''
+    One task per (variable, timestep, level) whose output is missing or out of date.
+    '''
+    from projections import cp_projections
+    from loader import SubsetLoader
+    from catalog import source_version
+
+    if spec['projection'] not in cp_projections():
+        raise ValueError(f"Unknown projection {spec['projection']}")
+    loader = SubsetLoader(spec['source'])
+    os.makedirs(spec['output'], exist_ok=True)
+
+    tasks, skipped = [], 0
+    for var in spec['variables']:
+        ntimes, nlevels = loader.steps(var)
+        timesteps = range(ntimes) if spec['timesteps'] == 'all' else spec['timesteps']
+        for t in timesteps:
+            for level in spec['levels']:
+                if level >= nlevels:
+                    continue
+                #Local files change in place, remote runs are told apart by their reference time
+                params = [loader.run_time, source_version(spec['source']), var, t, level] + \
+                         [spec[k] for k in ('projection', 'extent', 'contour_levels', 'cmap', 'size', 'dpi', 'coastlines', 'mode')]
+                digest = hashlib.sha1(json.dumps(params).encode()).hexdigest()[:10]
+                path = os.path.join(spec['output'], f'{var}_t{t:03d}_l{level:02d}_{digest}.png')
+                if os.path.exists(path) and not force:
+                    skipped += 1
+                    continue
+                tasks.append(dict(spec, var=var, time=t, level=level, path=path))
+    return tasks, skipped
+
+
+def render_task(task):
+    from projections import get_projection
+    from geometry import GeometryCache
+    from loader import SubsetLoader, ChunkCache
+    from render import render_map
+
+    source = task['source']
+    if source not in _loaders:
+        _loaders[source] = SubsetLoader(source, cache=ChunkCache())
+        _geometries[source] = GeometryCache()
+
+    fig = render_map(_loaders[source], _geometries[source], task['var'], task['time'], task['level'],
+                     get_projection(task['projection']), task['extent'], task['contour_levels'], task['cmap'],
+                     tuple(task['size']), task['coastlines'], mode=task['mode'])
+    #Write next to the target and rename, so an interrupted run never leaves a file that looks up to date
+    tmp = task['path'] + '.part'
+    fig.savefig(tmp, dpi=task['dpi'], format='png')
+    os.replace(tmp, task['path'])
+    return task['path']
+
+
+def run(specs, workers=None, force=False):
+    tasks, skipped = [], 0
+    for spec in specs:
+        new, old = make_tasks(spec, force)
+        tasks += new
+        skipped += old
+    print(f'{len(tasks)} to render, {skipped} up to date')
+    if not tasks:
+        return []
+
+    with ProcessPoolExecutor(max_workers=workers, initializer=use_agg, mp_context=pool_context()) as pool:
+        done = []
+        for path in pool.map(render_task, tasks):
+            print(path)
+            done.append(path)
+    return done
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Render Diana plots without a display.')
+    parser.add_argument('spec', help='JSON file describing the products')
+    parser.add_argument('--workers', type=int, default=None, help='number of processes, default is one per core')
+    parser.add_argument('--force', action='store_true', help='render outputs that are already up to date')
+    args = parser.parse_args(argv)
+    run(read_spec(args.spec), args.workers, args.force)
+
+
+if __name__ == '__main__':
+    use_agg()
+    sys.exit(main())
@@ -0,0 +1,300 @@
+'''
+Benchmarks of Diana's hot paths on synthetic MEPS and WRF files, so performance work can be
+checked offline.
+
+    python bench.py [--size small|medium|large] [--repeat N] [--workers N] [--output results.json] [name ...]
+
+The files are written to a temporary directory, shaped like MEPS (time, height, ensemble_member, y, x
+with 2-D latitude/longitude) and like wrfout (XLAT, XLONG, P, PB, T, PH, PHB, QNICE, ...).
+Results are JSON with the shapes, the commit and per benchmark the mean, min and all run times in seconds.
+'''
+from animation import use_agg
+import argparse, json, os, platform, subprocess, sys, tempfile, time
+import numpy as np
+
+SIZES = {'small': dict(time=6, height=10, ensemble=2, y=120, x=100),
+         'medium': dict(time=12, height=30, ensemble=3, y=400, x=300),
+         'large': dict(time=24, height=65, ensemble=5, y=949, x=739)}
+#Timed functions, filled in by @benchmark in the order they are defined
+BENCHMARKS = {}
+EXTENT = [5, 25, 58, 72]
+
+
+def make_meps(path, time=6, height=10, ensemble=2, y=120, x=100):
+    '''
+    MEPS-like file: fields over (time, height, ensemble_member, y, x) on a rotated 2-D lat/lon grid,
+    chunked one (time, level, member) slab per chunk like the thredds files.
+    '''
+    import xarray as xr
+    j, i = np.mgrid[0:y, 0:x]
+    lat = 55 + 20 * j / (y - 1) + 2 * i / (x - 1)
+    lon = 30 * i / (x - 1) + 5 * j / (y - 1) - 2
+    rng = np.random.default_rng(0)
+
+    def field(mean, amplitude, levels):
+        t = np.arange(time)[:, None, None, None, None]
+        z = np.arange(levels)[None, :, None, None, None]
+        wave = np.sin(np.radians(lon) * 6 + t / 3) * np.cos(np.radians(lat) * 4 - z / 10)
+        values = mean + amplitude * wave + rng.normal(0, amplitude / 10, (time, levels, ensemble, y, x))
+        return values.astype('f4')
+
+    dims, dims2m = ('time', 'hybrid', 'ensemble_member', 'y', 'x'), ('time', 'height1', 'ensemble_member', 'y', 'x')
+    ds = xr.Dataset({'air_temperature_ml': (dims, field(250, 20, height), {'units': 'K', 'standard_name': 'air_temperature'}),
+                     'x_wind_ml': (dims, field(0, 15, height), {'units': 'm/s', 'standard_name': 'x_wind'}),
+                     'y_wind_ml': (dims, field(0, 15, height), {'units': 'm/s', 'standard_name': 'y_wind'}),
+                     'air_temperature_2m': (dims2m, field(275, 10, 1), {'units': 'K', 'standard_name': 'air_temperature'}),
+                     'latitude': (('y', 'x'), lat, {'units': 'degree_north'}),
+                     'longitude': (('y', 'x'), lon, {'units': 'degree_east'}),
+                     'forecast_reference_time': ((), np.datetime64('2023-01-01T00:00'))},
+                    coords={'time': np.datetime64('2023-01-01T00:00') + np.arange(time) * np.timedelta64(1, 'h')})
+    encoding = {name: {'chunksizes': (1, 1, 1, y, x)} for name in ds.data_vars if ds[name].ndim == 5}
+    ds.to_netcdf(path, encoding=encoding)
+    return path
+
+
+def make_wrf(path, time=6, height=10, y=120, x=100):
+    '''
+    wrfout-like file over Andøya with the variables WRF_Output reads, chunked one timestep per chunk.
+    '''
+    from netCDF4 import Dataset
+    rng = np.random.default_rng(1)
+    data = Dataset(path, 'w')
+    for name, size in [('Time', None), ('bottom_top', height), ('bottom_top_stag', height + 1),
+                       ('south_north', y), ('west_east', x)]:
+        data.createDimension(name, size)
+
+    def variable(name, dims, values, units, description):
+        v = data.createVariable(name, 'f4', dims, chunksizes=(1,) + values.shape[1:] if dims[0] == 'Time' else None)
+        v[:] = values
+        v.units, v.description = units, description
+
+    lon, lat = np.meshgrid(np.linspace(6.97, 32.33, x), np.linspace(75.5, 81.2, y))
+    variable('XLAT', ('Time', 'south_north', 'west_east'), np.repeat(lat[None], time, 0), 'degree_north', 'LATITUDE, SOUTH IS NEGATIVE')
+    variable('XLONG', ('Time', 'south_north', 'west_east'), np.repeat(lon[None], time, 0), 'degree_east', 'LONGITUDE, WEST IS NEGATIVE')
+    xtime = data.createVariable('XTIME', 'f4', ('Time',))
+    xtime.units, xtime.description = 'minutes since 2019-11-11 12:00:00', 'minutes since simulation start'
+    xtime[:] = np.arange(time) * 60
+
+    full, stag = ('Time', 'bottom_top', 'south_north', 'west_east'), ('Time', 'bottom_top_stag', 'south_north', 'west_east')
+    z, zs = np.arange(height)[None, :, None, None], np.arange(height + 1)[None, :, None, None]
+    shape, shape_stag = (time, height, y, x), (time, height + 1, y, x)
+    variable('PB', full, np.broadcast_to(100000 * np.exp(-z / 8), shape), 'Pa', 'BASE STATE PRESSURE')
+    variable('P', full, rng.normal(0, 50, shape), 'Pa', 'perturbation pressure')
+    variable('T', full, rng.normal(0, 2, shape) + z, 'K', 'perturbation potential temperature (theta-t0)')
+    variable('PHB', stag, np.broadcast_to(9.81 * 500 * zs, shape_stag), 'm2 s-2', 'base-state geopotential')
+    variable('PH', stag, rng.normal(0, 5, shape_stag), 'm2 s-2', 'perturbation geopotential')
+    #Smooth patches of ice, pure noise would make contouring unrealistically slow
+    patches = np.sin(np.radians(lon) * 20 + np.arange(time)[:, None, None, None] / 2) * np.cos(np.radians(lat) * 40 - z / 5)
+    variable('QNICE', full, 1000 * np.maximum(patches, 0) + rng.gamma(2, 5, shape), '  kg-1', 'Ice Number concentration')
+    variable('SST', ('Time', 'south_north', 'west_east'), 270 + rng.normal(0, 1, (time, y, x)), 'K', 'SEA SURFACE TEMPERATURE')
+    data.close()
+    return path
+
+
+def benchmark(function):
+    BENCHMARKS[function.__name__] = function
+    return function
+
+
+def timed(run, repeat):
+    times = []
+    for i in range(repeat):
+        start = time.perf_counter()
+        run(i)
+        times.append(time.perf_counter() - start)
+    return {'mean': float(np.mean(times)), 'min': float(np.min(times)), 'runs': times}
+
+
+def map_figure(projection, extent):
+    from matplotlib.figure import Figure
+    from matplotlib.backends.backend_agg import FigureCanvasAgg
+    import cartopy.crs as ccrs
+    fig = Figure(figsize=(12, 8))
+    FigureCanvasAgg(fig)
+    map = fig.add_subplot(projection=projection)
+    map.set_extent(extent, crs=ccrs.PlateCarree())
+    return fig, map
+
+
+def projection():
+    import cartopy.crs as ccrs
+    return ccrs.LambertConformal(central_longitude=15, central_latitude=65)
+
+
+#Each benchmark does its setup and returns the function to time, called with the run number
+
+@benchmark
+def open_dataset(context):
+    from loader import SubsetLoader
+    return lambda i: SubsetLoader(context['meps']).dataset.close()
+
+
+@benchmark
+def read_slice(context):
+    from loader import SubsetLoader
+    loader = SubsetLoader(context['meps'])
+    ntimes, nlevels = loader.steps('air_temperature_ml')
+    return lambda i: loader.read('air_temperature_ml', i % ntimes, i % nlevels, EXTENT)
+
+
+@benchmark
+def triangulate(context):
+    from loader import SubsetLoader
+    from geometry import GridGeometry
+    values, lon, lat = SubsetLoader(context['meps']).read('air_temperature_2m', 0, 0, EXTENT)
+    proj = projection()
+    return lambda i: GridGeometry(lon, lat, proj, EXTENT)
+
+
+@benchmark
+def contour(context):
+    #plot_variable once the grid is triangulated: contouring only
+    from loader import SubsetLoader
+    from geometry import GeometryCache
+    from render import draw_field
+    loader, geometry = SubsetLoader(context['meps']), GeometryCache()
+    fig, map = map_figure(projection(), EXTENT)
+    slices = [loader.read('air_temperature_2m', t, 0, EXTENT) for t in range(loader.steps('air_temperature_2m')[0])]
+
+    def run(i):
+        values, lon, lat = slices[i % len(slices)]
+        draw_field(map, geometry.get(lon, lat, map.projection, EXTENT), values).remove()
+    return run
+
+
+@benchmark
+def raster(context):
+    from loader import SubsetLoader
+    from geometry import GeometryCache
+    from render import draw_raster
+    loader, geometry = SubsetLoader(context['meps']), GeometryCache(directory=context['weights'])
+    fig, map = map_figure(projection(), EXTENT)
+    slices = [loader.read('air_temperature_2m', t, 0, EXTENT) for t in range(loader.steps('air_temperature_2m')[0])]
+    values, lon, lat = slices[0]
+    shape = (int(map.bbox.height), int(map.bbox.width))
+    weights = geometry.raster(lon, lat, map.projection, EXTENT, map.get_extent(), shape)
+
+    def run(i):
+        draw_raster(map, weights, slices[i % len(slices)][0]).remove()
+    return run
+
+
+@benchmark
+def update_map(context):
+    #Full Agg redraw of the map canvas with coastlines and a contoured field, as after update_map in the GUI
+    from loader import SubsetLoader
+    from geometry import GeometryCache
+    from render import draw_field
+    values, lon, lat = SubsetLoader(context['meps']).read('air_temperature_2m', 0, 0, EXTENT)
+    fig, map = map_figure(projection(), EXTENT)
+    map.coastlines()
+    draw_field(map, GeometryCache().get(lon, lat, map.projection, EXTENT), values)
+    return lambda i: fig.canvas.draw()
+
+
+@benchmark
+def blit_layers(context):
+    #update_layers in the GUI: restore the cached background and draw only the field on top
+    from loader import SubsetLoader
+    from geometry import GeometryCache
+    from render import draw_field
+    values, lon, lat = SubsetLoader(context['meps']).read('air_temperature_2m', 0, 0, EXTENT)
+    fig, map = map_figure(projection(), EXTENT)
+    map.coastlines()
+    contour = draw_field(map, GeometryCache().get(lon, lat, map.projection, EXTENT), values)
+    contour.set_animated(True)
+    fig.canvas.draw()
+    background = fig.canvas.copy_from_bbox(fig.bbox)
+
+    def run(i):
+        fig.canvas.restore_region(background)
+        map.draw_artist(contour)
+    return run
+
+
+@benchmark
+def area_plot(context):
+    from test import open_output
+    output = open_output(context['wrf'], context['plots'])
+    ntimes = output.data.variables['QNICE'].shape[0]
+    return lambda i: output.area_plot('QNICE', i % ntimes, savefig=False).canvas.draw()
+
+
+@benchmark
+def area_plot_raster(context):
+    from test import open_output
+    from geometry import GeometryCache
+    output = open_output(context['wrf'], context['plots'])
+    #Weights go to the scratch directory, not the user's cache
+    output.template().geometry = GeometryCache(directory=context['weights'])
+    ntimes = output.data.variables['QNICE'].shape[0]
+    return lambda i: output.area_plot('QNICE', i % ntimes, savefig=False, mode='raster').canvas.draw()
+
+
+@benchmark
+def number_conc_profile(context):
+    import matplotlib.pyplot as plt
+    from test import open_output
+    output = open_output(context['wrf'], context['plots'])
+    ntimes = output.data.variables['QNICE'].shape[0]
+
+    def run(i):
+        output.diag.clear()
+        fig = output.number_conc_profile('QNICE', 0, ntimes - 1, loc=(78.0, 15.0), savefig=False)
+        plt.close(fig)
+    return run
+
+
+@benchmark
+def create_animation(context):
+    from test import open_output
+    output = open_output(context['wrf'], context['plots'])
+    ntimes = output.data.variables['QNICE'].shape[0]
+    return lambda i: output.create_animation('QNICE', n_frames=ntimes, workers=context['workers'])
+
+
+def commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', 'HEAD'], capture_output=True, text=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip() or None
+    except OSError:
+        return None
+
+
+def run(size='small', repeat=5, workers=None, names=None):
+    shape = SIZES[size]
+    results = {}
+    with tempfile.TemporaryDirectory() as directory:
+        context = {'meps': make_meps(os.path.join(directory, 'meps.nc'), **shape),
+                   'wrf': make_wrf(os.path.join(directory, 'wrfout_d01.nc'), shape['time'], shape['height'], shape['y'], shape['x']),
+                   'plots': directory + os.sep, 'weights': os.path.join(directory, 'weights'), 'workers': workers}
+        for name in names or BENCHMARKS:
+            print(name, file=sys.stderr)
+            results[name] = timed(BENCHMARKS[name](context), repeat)
+    return {'size': size, 'shape': shape, 'repeat': repeat, 'workers': workers, 'commit': commit(),
+            'python': platform.python_version(), 'machine': platform.machine(), 'results': results}
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Time Diana on synthetic MEPS and WRF files.')
+    parser.add_argument('names', nargs='*', help=f'benchmarks to run, default is all of {", ".join(BENCHMARKS)}')
+    parser.add_argument('--size', choices=SIZES, default='small', help='size of the synthetic files')
+    parser.add_argument('--repeat', type=int, default=5, help='timed runs per benchmark')
+    parser.add_argument('--workers', type=int, default=None, help='processes used by create_animation')
+    parser.add_argument('--output', default=None, help='JSON file for the results, default is stdout')
+    args = parser.parse_args(argv)
+    unknown = set(args.names) - set(BENCHMARKS)
+    if unknown:
+        parser.error(f'unknown benchmarks {", ".join(sorted(unknown))}')
+
+    results = json.dumps(run(args.size, args.repeat, args.workers, args.names), indent=2)
+    if args.output is None:
+        print(results)
+    else:
+        with open(args.output, 'w') as f:
+            f.write(results + '\n')
+
+
+if __name__ == '__main__':
+    use_agg()
+    sys.exit(main())
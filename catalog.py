@@ -0,0 +1,219 @@
+from matplotlib.ticker import MaxNLocator
+import numpy as np, hashlib, json, os, warnings
+
+CATALOG_DIR = os.path.join(os.path.expanduser('~'), '.cache', 'diana', 'catalogs')
+
+
+def attributes(variable):
+    #xarray variables carry .attrs, netCDF4 variables list theirs with ncattrs()
+    if hasattr(variable, 'attrs'):
+        return dict(variable.attrs)
+    return {name: variable.getncattr(name) for name in variable.ncattrs()}
+
+
+def chunk_layout(variable):
+    if hasattr(variable, 'chunking'):
+        chunks = variable.chunking()
+        return None if chunks == 'contiguous' else [int(c) for c in chunks]
+    chunks = variable.encoding.get('chunksizes')
+    return None if chunks is None else [int(c) for c in chunks]
+
+
+def slice_statistics(values):
+    values = np.asarray(values, dtype=float)
+    if not np.isfinite(values).any():
+        return np.full(3, np.nan)
+    return np.array([np.nanmin(values), np.nanmax(values), np.nanmean(values)])
+
+
+def field_statistics(variable):
+    '''
+    (time, level, 3) array of min, max and mean of each 2-D slice, read one timestep at a time.
+    Middle dimensions after the level are taken at index 0, like SubsetLoader does.
+    '''
+    shape = variable.shape
+    nlevels = shape[1] if len(shape) > 3 else 1
+    stats = np.full((shape[0], nlevels, 3), np.nan)
+    for t in range(shape[0]):
+        key = (t,) + (slice(None),) * (len(shape) > 3) + (0,) * max(len(shape) - 4, 0) + (slice(None), slice(None))
+        values = np.ma.filled(np.ma.asarray(variable[key], dtype=float), np.nan).reshape(nlevels, -1)
+        with warnings.catch_warnings():
+            #All-NaN slices give NaN statistics
+            warnings.simplefilter('ignore', RuntimeWarning)
+            stats[t] = np.stack([np.nanmin(values, 1), np.nanmax(values, 1), np.nanmean(values, 1)], 1)
+    return stats
+
+
+class Catalog:
+    '''
+    Dimensions, units, descriptions and chunk layout of every variable in a dataset, plus
+    min/max/mean of each (variable, time, level) slice of the fields. Stored as a JSON sidecar
+    so reopening a dataset does not touch the data.
+    The full statistics need a pass over every field, which for a remote dataset means downloading it.
+    Until a variable has them, the slices that were read anyway are observed and their ranges used instead.
+    Parameters:
+    -----------
+    version   - identifies the state of the data (file mtime and size, or the run time)
+    variables - {name: {'dims', 'shape', 'dtype', 'units', 'description', 'chunks'}}
+    stats     - {name: (time, level, 3) array of min, max, mean}
+    '''
+    def __init__(self, version, variables, stats=None):
+        self.version = version
+        self.variables = variables
+        self.stats = {} if stats is None else stats
+        #{name: {(time, level): (min, max, mean)}} of the slices read this session, never saved
+        self.observed = {}
+
+    @classmethod
+    def build(cls, dataset, version=None, stats=True):
+        '''
+        Catalog of an xarray or netCDF4 Dataset, stats=False leaves out the pass over the data.
+        '''
+        variables = {}
+        for name, variable in dataset.variables.items():
+            attrs = attributes(variable)
+            dims = variable.dims if hasattr(variable, 'dims') else variable.dimensions
+            variables[name] = {'dims': [str(d) for d in dims],
+                               'shape': [int(s) for s in variable.shape], 'dtype': str(variable.dtype),
+                               'units': None if 'units' not in attrs else str(attrs['units']),
+                               'description': next((str(attrs[k]) for k in ('description', 'long_name', 'standard_name')
+                                                    if k in attrs), None),
+                               'chunks': chunk_layout(variable)}
+        catalog = cls(version, variables)
+        if stats:
+            catalog.add_statistics(dataset)
+        return catalog
+
+    def fields(self):
+        #Variables with time and two horizontal dimensions at least, the ones that can be mapped
+        return [name for name, info in self.variables.items() if len(info['shape']) >= 3]
+
+    def add_statistics(self, dataset, names=None, path=None):
+        '''
+        Fill in the statistics of names (default all fields) one variable at a time, saving to path
+        after each so an interrupted pass keeps what it has done.
+        '''
+        for name in self.fields() if names is None else names:
+            if name in self.stats or not np.issubdtype(np.dtype(self.variables[name]['dtype']), np.number):
+                continue
+            self.stats[name] = field_statistics(dataset.variables[name])
+            if path is not None:
+                self.save(path)
+
+    def observe(self, var, time, level, values):
+        '''
+        Record the range of a slice that was read for display, possibly only a window of the field.
+        Safe to call from reader threads.
+        '''
+        if var not in self.stats:
+            self.observed.setdefault(var, {})[time, level] = slice_statistics(values)
+
+    def field_range(self, var, times=None, levels=None):
+        '''
+        Smallest minimum and largest maximum of var over the given timesteps and levels (default all),
+        from the statistics of var, or from the slices observed so far. None when neither is there.
+        '''
+        if var in self.stats:
+            stats = self.stats[var]
+            stats = stats[slice(None) if times is None else np.atleast_1d(times)]
+            stats = stats[:, slice(None) if levels is None else np.atleast_1d(levels)]
+        else:
+            times = None if times is None else set(np.atleast_1d(times).tolist())
+            levels = None if levels is None else set(np.atleast_1d(levels).tolist())
+            stats = np.array([s for (t, l), s in list(self.observed.get(var, {}).items())
+                              if (times is None or t in times) and (levels is None or l in levels)]).reshape(-1, 3)
+        if len(stats) == 0 or np.isnan(stats[..., :2]).all():
+            return None
+        return float(np.nanmin(stats[..., 0])), float(np.nanmax(stats[..., 1]))
+
+    def contour_levels(self, var, n=10, times=None, levels=None):
+        '''
+        n contour levels covering var over the given timesteps and levels, the same for every frame.
+        '''
+        bounds = self.field_range(var, times, levels)
+        if bounds is None:
+            return None
+        return MaxNLocator(n + 1).tick_values(*bounds)
+
+    def write_listing(self, path):
+        '''
+        Table of name, units, dimensions, shape and description of every variable.
+        '''
+        with open(path, 'w') as f:
+            for name, info in self.variables.items():
+                unit = info['units'] or ' '
+                dim, shp = str(tuple(info['dims'])), str(tuple(info['shape']))
+                des = info['description'] or ' '
+                f.write(f'{name:22s}{unit:20s}{dim:60s}{shp:20s}{des:85s}')
+                f.write('\n')
+                f.write(u'─' * 205)
+                f.write('\n')
+
+    def save(self, path):
+        #NaN is written as null to keep the file plain JSON
+        stats = {name: np.where(np.isnan(s), None, s).tolist() for name, s in self.stats.items()}
+        tmp = path + '.part'
+        with open(tmp, 'w') as f:
+            json.dump({'version': self.version, 'variables': self.variables, 'stats': stats}, f)
+        os.replace(tmp, path)
+
+    @classmethod
+    def load(cls, path):
+        with open(path) as f:
+            data = json.load(f)
+        stats = {name: np.array(s, dtype=float) for name, s in data['stats'].items()}
+        return cls(data['version'], data['variables'], stats)
+
+
+def source_version(source):
+    '''
+    [mtime, size] of a local file, which change when it is rewritten in place. None for urls,
+    whose runs are told apart by their reference time. Used in every key derived from a source.
+    '''
+    if os.path.exists(source):
+        return [os.path.getmtime(source), os.path.getsize(source)]
+    return None
+
+
+def catalog_paths(source):
+    '''
+    Sidecar next to a local file first, then the user cache, which is the only place for urls.
+    '''
+    cached = os.path.join(CATALOG_DIR, hashlib.sha1(str(source).encode()).hexdigest() + '.json')
+    if os.path.exists(source):
+        return [str(source) + '.catalog.json', cached]
+    return [cached]
+
+
+def open_catalog(dataset, source, version=None, stats=True):
+    '''
+    Catalog of dataset, read from its sidecar when that matches version, otherwise built and saved.
+    Parameters:
+    -----------
+    dataset - opened xarray or netCDF4 Dataset
+    source  - file path or url the dataset was opened from
+    version - state of the data, default is the mtime and size of a local file
+    stats   - compute the field statistics now, otherwise they can be added later with add_statistics
+    Returns the catalog and the path it is saved to.
+    '''
+    version = source_version(source) if version is None else version
+    paths = catalog_paths(source)
+    for path in paths:
+        try:
+            catalog = Catalog.load(path)
+        except (OSError, ValueError, KeyError):
+            continue
+        if catalog.version == version:
+            if stats:
+                catalog.add_statistics(dataset, path=path)
+            return catalog, path
+
+    catalog = Catalog.build(dataset, version, stats)
+    for path in paths:
+        try:
+            os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+            catalog.save(path)
+            return catalog, path
+        except OSError:
+            continue
+    return catalog, None
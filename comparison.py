@@ -0,0 +1,212 @@
+from matplotlib.ticker import MaxNLocator
+from animation import render_frames, save_animation
+from geometry import GeometryCache
+from template import PlotTemplate
+from timing import span
+import numpy as np, os
+
+KINDS = ('difference', 'ratio', 'bias', 'paired')
+#Diverging colormap for the fields centred on zero or one
+CMAPS = {'difference': 'RdBu_r', 'ratio': 'RdBu_r', 'bias': 'RdBu_r', 'paired': None}
+
+#Comparisons opened by unpickling, so the frames a worker process renders share one set of regridding weights
+_compared = {}
+
+
+def run_key(run):
+    #Same identity as open_output uses, chunks can be an unhashable dict
+    return run.output_file, run.plotpath, repr(run.chunks)
+
+
+def open_comparison(reference, other, labels=None):
+    key = (run_key(reference), run_key(other), labels)
+    if key not in _compared:
+        _compared[key] = Comparison(reference, other, labels)
+    return _compared[key]
+
+
+def run_label(output_file):
+    #The runs are kept in one directory per microphysics scheme, e.g. .../Milbrandt/wrfout_d01_...
+    return os.path.basename(os.path.dirname(os.path.abspath(output_file))) or os.path.basename(output_file)
+
+
+class Comparison:
+    '''
+    Two WRF runs, e.g. two microphysics schemes on different domains, compared on the grid of the
+    reference. The regridding weights from the other domain are computed once (and stored on disk),
+    then both runs are read one time slice at a time, so memory stays at one slice of each whatever
+    the number of hours and levels.
+    Parameters:
+    -----------
+    reference - WRF_Output whose grid the fields are compared on
+    other     - WRF_Output regridded onto the reference, at the same timesteps and model levels
+    labels    - names of the two runs in titles, default is the directory of each file
+    '''
+    def __init__(self, reference, other, labels=None):
+        self.reference = reference
+        self.other = other
+        self.labels = labels
+        self.names = labels or (run_label(reference.output_file), run_label(other.output_file))
+        self.weights = GeometryCache().regrid(other.lon, other.lat, reference.lon, reference.lat)
+        self.ntimes = min(reference.shape('XTIME')[0], other.shape('XTIME')[0])
+        self.templates = {}
+        self.biases = {}
+
+    def __reduce__(self):
+        return open_comparison, (self.reference, self.other, self.labels)
+
+    def template(self, kind, only_andoya=True):
+        ncols = 2 if kind == 'paired' else 1
+        extent = self.reference.template(only_andoya).extent
+        if (extent, ncols) not in self.templates:
+            self.templates[extent, ncols] = PlotTemplate(extent, (8 * ncols, 9), ncols)
+        return self.templates[extent, ncols]
+
+    def key(self, var, time, height=None):
+        #height=None takes every model level of a 3-D variable
+        if len(self.reference.shape(var)) == 3:
+            return (time, slice(None), slice(None))
+        return (time, slice(None) if height is None else height, slice(None), slice(None))
+
+    def pair(self, var, time, height=None):
+        '''
+        var at one timestep (and level) of the reference and of the other run regridded onto it.
+        '''
+        key = self.key(var, time, height)
+        with span('read', var=var, time=time):
+            reference = np.asarray(self.reference.read(var, key), dtype=float)
+            other = np.asarray(self.other.read(var, key), dtype=float)
+        with span('regrid'):
+            return reference, self.weights.regrid(other)
+
+    def field(self, var, time, height=None, kind='difference'):
+        '''
+        other - reference for kind='difference', other / reference for kind='ratio' (NaN where the reference is 0).
+        '''
+        reference, other = self.pair(var, time, height)
+        if kind == 'difference':
+            return other - reference
+        if kind == 'ratio':
+            with np.errstate(divide='ignore', invalid='ignore'):
+                return np.where(reference != 0, other / reference, np.nan)
+        raise ValueError(f'unknown comparison {kind!r}')
+
+    def stream(self, var, kind='difference', times=None, height=None):
+        '''
+        Yield (time, field) for each timestep, only one time slice of each run is held at a time.
+        '''
+        for time in range(self.ntimes) if times is None else times:
+            yield time, self.field(var, time, height, kind)
+
+    def bias(self, var, times=None, height=None):
+        '''
+        Mean and root mean square of other - reference over the timesteps (default all), per grid point
+        and level, accumulated slice by slice.
+        '''
+        total = squares = count = None
+        for time, difference in self.stream(var, 'difference', times, height):
+            valid = np.isfinite(difference)
+            difference = np.where(valid, difference, 0)
+            if total is None:
+                total, squares, count = np.zeros_like(difference), np.zeros_like(difference), np.zeros(difference.shape)
+            total += difference
+            squares += difference**2
+            count += valid
+        with np.errstate(divide='ignore', invalid='ignore'):
+            return total / count, np.sqrt(squares / count)
+
+    def field_range(self, var, kind='difference', times=None, height=None):
+        '''
+        Smallest and largest finite value of the comparison over the timesteps, in one streaming pass.
+        For kind='paired' that is the range of var in both runs on their own grids.
+        '''
+        low, high = np.inf, -np.inf
+        for time in range(self.ntimes) if times is None else times:
+            if kind == 'paired':
+                key = self.key(var, time, height)
+                fields = [np.asarray(run.read(var, key), dtype=float) for run in (self.reference, self.other)]
+            else:
+                fields = [self.field(var, time, height, kind)]
+            for field in fields:
+                if np.isfinite(field).any():
+                    low, high = min(low, np.nanmin(field)), max(high, np.nanmax(field))
+        return (low, high) if low <= high else None
+
+    def contour_levels(self, var, kind='difference', n=10, times=None, height=None):
+        '''
+        Levels shared by every frame and both maps: the union of both catalog ranges for kind='paired'
+        (a streaming pass for derived variables), symmetric about zero for differences, from a
+        streaming pass for ratios.
+        '''
+        if kind == 'paired':
+            levels = [run.contour_levels(var, n, times, height) for run in (self.reference, self.other)]
+            if all(l is not None for l in levels):
+                return MaxNLocator(n + 1).tick_values(min(l[0] for l in levels), max(l[-1] for l in levels))
+        if kind == 'bias':
+            bias = self.biases.get((var, height))
+            bounds = None if bias is None or not np.isfinite(bias).any() else (np.nanmin(bias), np.nanmax(bias))
+        else:
+            bounds = self.field_range(var, kind, times, height)
+        if bounds is None:
+            return None
+        if kind in ('ratio', 'paired'):
+            return MaxNLocator(n + 1).tick_values(*bounds)
+        limit = max(abs(bounds[0]), abs(bounds[1])) or 1
+        return MaxNLocator(n + 1, symmetric=True).tick_values(-limit, limit)
+
+    def area_plot(self, var, start_time, height=0, kind='difference', only_andoya=True, levels=None, title=None, savefig=True, mode='contour'):
+        '''
+        Map of the comparison of var at one timestep and model level.
+        Parameters:
+        -----------
+        kind        - 'difference' (other - reference), 'ratio' (other / reference), 'bias' (mean difference
+                      over all timesteps, start_time is ignored) or 'paired' (both runs side by side)
+        levels      - contour levels, give them when plotting frames of an animation so they do not change
+        savefig     - save the figure to the plotpath of the reference, otherwise only return it
+        mode        - 'contour' for filled contours, 'raster' for an image from precomputed interpolation weights
+        '''
+        with span('comparison_plot', var=var, time=start_time, height=height, kind=kind):
+            template = self.template(kind, only_andoya)
+            hour = int(self.reference.start_hour) + start_time
+            when = self.reference.date + ' ' + str(hour) + ':00:00 '
+            lon, lat = self.reference.lon, self.reference.lat
+            if kind == 'paired':
+                key = self.key(var, start_time, height)
+                with span('read'):
+                    fields = [(run.lon, run.lat, np.asarray(run.read(var, key))) for run in (self.reference, self.other)]
+                titles = [when + name + ' ' + var + ' height=' + str(height) for name in self.names]
+            elif kind == 'bias':
+                if (var, height) not in self.biases:
+                    self.biases[var, height] = self.bias(var, height=height)[0]
+                fields = [(lon, lat, self.biases[var, height])]
+                titles = [f'{var} mean {self.names[1]} - {self.names[0]} height={height}']
+            else:
+                fields = [(lon, lat, self.field(var, start_time, height, kind))]
+                sign = ' - ' if kind == 'difference' else ' / '
+                titles = [when + var + ' ' + self.names[1] + sign + self.names[0] + ' height=' + str(height)]
+
+            #Levels are always fixed here, the maps of a paired plot share one colorbar
+            if levels is None:
+                levels = self.contour_levels(var, kind, times=[start_time], height=height)
+            with span('draw'):
+                fig = template.draw_maps(fields, levels, titles, mode, CMAPS[kind])
+            if savefig:
+                title = f'{var}_{kind}_{start_time}.png' if title is None else title
+                with span('savefig'):
+                    fig.savefig(self.reference.plotpath + title)
+        return fig
+
+    def create_animation(self, var, height=0, kind='difference', only_andoya=True, levels=None, n_frames=None, workers=None, fmt='gif', mode='contour'):
+        '''
+        Paired or difference/ratio animation over time, frames rendered in parallel and streamed into the writer.
+        Levels default to one range over all frames, which for differences and ratios costs a streaming pass.
+        '''
+        n_frames = self.ntimes if n_frames is None else min(n_frames, self.ntimes)
+        if kind not in ('difference', 'ratio', 'paired'):
+            raise ValueError(f'cannot animate {kind!r}')
+        if levels is None:
+            levels = self.contour_levels(var, kind, times=range(n_frames), height=height)
+        frames = [dict(var=var, start_time=t, height=height, kind=kind, only_andoya=only_andoya, levels=levels, mode=mode)
+                  for t in range(n_frames)]
+        title = f'{var}_{kind}_animation.{fmt}'
+        save_animation(render_frames(self.area_plot, frames, workers), self.reference.plotpath + title, duration=200, loop=0)
@@ -0,0 +1,85 @@
+from diagnostics import full_pressure, air_temperature, air_density
+import numpy as np
+
+#Registry of derived variables by name, filled in by @derived below
+DERIVED = {}
+
+
+class Derived:
+    '''
+    A variable computed from others, evaluated on the same (time, level, window) slice as
+    its inputs, so only the part that is plotted is ever read.
+    Parameters:
+    -----------
+    name     - name shown next to the raw variables
+    inputs   - names of the variables the function takes, in order
+    function - function(*inputs) returning the derived field in one vectorised pass
+    '''
+    def __init__(self, name, inputs, function, units=None, description=None):
+        self.name = name
+        self.inputs = inputs
+        self.function = function
+        self.units = units
+        self.description = description
+
+    def evaluate(self, read):
+        '''
+        read(name) returns an input restricted to the wanted slice, as a NumPy or dask array.
+        '''
+        return self.function(*(read(name) for name in self.inputs))
+
+
+def derived(name, inputs, units=None, description=None):
+    def register(function):
+        DERIVED[name] = Derived(name, inputs, function, units, description)
+        return function
+    return register
+
+
+def available(variables):
+    '''
+    Derived variables whose inputs are all among variables, in registration order.
+    '''
+    return [name for name, var in DERIVED.items() if name not in variables and all(i in variables for i in var.inputs)]
+
+
+def is_derived(var, variables):
+    return var not in variables and var in DERIVED
+
+
+#MEPS
+
+for level in ('ml', '10m', 'pl'):
+    derived(f'wind_speed_{level}', (f'x_wind_{level}', f'y_wind_{level}'), 'm/s', 'wind speed')(np.hypot)
+
+for level in ('ml', '2m', 'pl'):
+    @derived(f'air_temperature_{level}_celsius', (f'air_temperature_{level}',), 'degC', 'air temperature')
+    def celsius(T):
+        return T - 273.15
+
+
+#WRF
+
+derived('pressure', ('P', 'PB'), 'Pa', 'full pressure')(full_pressure)
+
+
+@derived('temperature', ('T', 'P', 'PB'), 'K', 'air temperature')
+def temperature(T, P, PB):
+    return air_temperature(T, P + PB)
+
+
+@derived('temperature_celsius', ('T', 'P', 'PB'), 'degC', 'air temperature')
+def temperature_celsius(T, P, PB):
+    return air_temperature(T, P + PB) - 273.15
+
+
+@derived('density', ('T', 'P', 'PB'), 'kg m-3', 'air density')
+def density(T, P, PB):
+    p = P + PB
+    return air_density(p, air_temperature(T, p))
+
+
+for q in ('QNICE', 'QNCLOUD', 'QNRAIN', 'QNSNOW', 'QNGRAUPEL'):
+    @derived(f'{q}_per_liter', (q, 'T', 'P', 'PB'), 'L-1', 'number concentration per litre')
+    def per_liter(N, T, P, PB):
+        return N * density(T, P, PB) / 1000
@@ -0,0 +1,123 @@
+from collections import OrderedDict
+import numpy as np
+
+P0 = 100000
+CP = 1004.5
+G = 9.81
+
+
+def full_pressure(P, PB):
+    return P + PB
+
+
+def air_temperature(T, p, R=287):
+    '''
+    Air temperature in K from the perturbation potential temperature T (theta - 300) and pressure p in Pa.
+    '''
+    return (300 + T) * (p / P0) ** (R / CP)
+
+
+def air_density(p, temperature, R=287):
+    return p / (R * temperature)
+
+
+def hashable(index):
+    #Slices are not hashable before Python 3.12
+    if isinstance(index, slice):
+        return ('slice', index.start, index.stop, index.step)
+    if isinstance(index, np.ndarray):
+        return tuple(index.tolist())
+    return index
+
+
+class Diagnostics:
+    '''
+    Pressure, temperature, air density and geopotential height of a WRF run over
+    (time, z, y, x) slices, computed with NumPy broadcasting instead of per column.
+    Fields keep the precision of the file (float32 for WRF) and results are memoized per slice,
+    least recently used first within max_bytes. Source variables are only memoized for slices
+    small enough to share, the whole-domain inputs of a diagnostic are dropped once it is computed.
+    When read returns dask arrays every result stays lazy until it is computed, and costs no memory.
+    Parameters:
+    -----------
+    read      - function read(var, key) returning var[key] as a NumPy or dask array
+    R         - gas constant of dry air
+    max_bytes - memory held by the memo
+    '''
+    def __init__(self, read, R=287, max_bytes=512 * 2**20):
+        self.read = read
+        self.R = R
+        self.max_bytes = max_bytes
+        self.memo = OrderedDict()
+        self.size = 0
+
+    def cached(self, name, key, compute, limit=None):
+        '''
+        compute() memoized under (name, key), unless it holds more than limit bytes (default max_bytes).
+        '''
+        memo_key = (name,) + tuple(hashable(i) for i in key)
+        if memo_key in self.memo:
+            self.memo.move_to_end(memo_key)
+            return self.memo[memo_key]
+        value = compute()
+        nbytes = value.nbytes if isinstance(value, np.ndarray) else 0
+        if nbytes > (self.max_bytes if limit is None else limit):
+            return value
+        self.memo[memo_key] = value
+        self.size += nbytes
+        while self.size > self.max_bytes:
+            _, old = self.memo.popitem(last=False)
+            self.size -= old.nbytes if isinstance(old, np.ndarray) else 0
+        return value
+
+    def clear(self):
+        self.memo.clear()
+        self.size = 0
+
+    def source(self, var, key):
+        def read():
+            values = self.read(var, key)
+            #Integer fields are converted, float fields keep the file's precision
+            return values if values.dtype.kind == 'f' else values.astype(np.float32)
+        return self.cached(var, key, read, self.max_bytes // 16)
+
+    def pressure(self, time=slice(None), z=slice(None), y=slice(None), x=slice(None)):
+        '''
+        Full pressure P + PB in Pa.
+        '''
+        key = (time, z, y, x)
+        return self.cached('pressure', key, lambda: full_pressure(self.source('P', key), self.source('PB', key)))
+
+    def temperature(self, time=slice(None), z=slice(None), y=slice(None), x=slice(None)):
+        '''
+        Air temperature in K from the perturbation potential temperature T (theta - 300).
+        '''
+        key = (time, z, y, x)
+        return self.cached('temperature', key, lambda: air_temperature(self.source('T', key), self.pressure(*key), self.R))
+
+    def density(self, time=slice(None), z=slice(None), y=slice(None), x=slice(None)):
+        '''
+        Air density in kg m-3.
+        '''
+        key = (time, z, y, x)
+        return self.cached('density', key, lambda: air_density(self.pressure(*key), self.temperature(*key), self.R))
+
+    def height(self, time=slice(None), z=slice(None), y=slice(None), x=slice(None)):
+        '''
+        Geopotential height (PH + PHB) / g in m, destaggered to the mass levels.
+        '''
+        key = (time, z, y, x)
+        def compute():
+            #Staggered levels are read in full and averaged before z is applied
+            stag = (time, slice(None), y, x)
+            H = (self.source('PH', stag) + self.source('PHB', stag)) / G
+            axis = 0 if np.isscalar(time) else 1
+            H = 0.5 * (np.take(H, np.arange(H.shape[axis] - 1), axis) + np.take(H, np.arange(1, H.shape[axis]), axis))
+            return H[(slice(None),) * axis + (z,)]
+        return self.cached('height', key, compute)
+
+    def per_liter(self, values, time=slice(None), z=slice(None), y=slice(None), x=slice(None)):
+        '''
+        Convert a number concentration per kg of air to per litre.
+        '''
+        return values * self.density(time, z, y, x) / 1000
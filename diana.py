@@ -1,19 +1,34 @@
-import matplotlib.pyplot as plt, numpy as np, cartopy as cp, PIL
-from matplotlib.tri import Triangulation
-import cartopy.crs as ccrs, tkinter as tk, io, time
-from matplotlib.backends.backend_tkagg import FigureCanvasTkAgg, NavigationToolbar2Tk
-from projections import cp_projections
-import xarray as xr
+import time
+started = time.perf_counter()
+import tkinter as tk, argparse, importlib, io, sys, threading
+from projections import cp_projections, get_projection
+from timing import tracer, span
+
+#Imported on a thread once the window is up, methods import what they need locally
+HEAVY_MODULES = ['numpy', 'matplotlib.figure', 'matplotlib.backends.backend_tkagg', 'cartopy.crs',
+                 'xarray', 'geometry', 'render', 'loader', 'prefetch', 'tiles', 'features']
+#Seconds from start until the window is shown, checked by --startup-check
+STARTUP_TARGET = 1.0
+#Spans shown in the status bar while tracing
+STAGES = ['load_arome', 'read', 'triangulate', 'raster_weights', 'contour', 'raster', 'colorbar', 'tile',
+          'canvas.draw', 'blit', 'redraw_map']
+
+
+def import_heavy_modules():
+    for name in HEAVY_MODULES:
+        importlib.import_module(name)
 
 
 class DianaProgram:
-    def __init__(self, size=(1200, 700), title='Diana v0.1'):
+    def __init__(self, size=(1200, 700), title='Diana v0.1', source=None, server=None, statistics=False):
+        self.source = source
+        self.server = server
+        self.statistics = statistics
         self.width, self.height = size
         self.Window = tk.Tk()
         self.Window.title(title)
         self.Window.geometry(str(self.width) + 'x' + str(self.height))
         self.Window.columnconfigure(1, minsize=2/3*self.width)
-        self.dpi = 1/plt.rcParams['figure.dpi']
         self.leftcolumn = tk.Frame(self.Window, width=20, height=self.window_height, bg='grey')
         self.rightcolumn = tk.Frame(self.Window, height = self.window_height)
 
@@ -27,40 +42,111 @@ class DianaProgram:
         self.heightstep = 0
         self.plotlevels = 10
         self.cmap = 'coolwarm'
+        self.geometry = None
+        self.pending = None
+        self.render_mode = 'contour'
+        self.tiles = None
+        self.tile_cache = None
+        self.features = None
+        self.feature_views = {}
+        self.view_pending = False
 
         self.get_map_extent()
+        #Buttons that draw on the map are enabled by finish_startup, once the map exists
         self._drawCoastlinesButton = tk.Button(
-            self.leftcolumn, text='Coastlines', command=self.update_coast, padx=30, pady=5, bg='grey').pack(fill=tk.X)#.grid(column=0, row=2)
+            self.leftcolumn, text='Coastlines', command=self.update_coast, padx=30, pady=5, bg='grey', state=tk.DISABLED)
+        self._drawCoastlinesButton.pack(fill=tk.X)#.grid(column=0, row=2)
         self._drawStockImg = tk.Button(
-            self.leftcolumn, text='Background', command=self.update_stock_img, padx=30, pady=5, bg='grey').pack(fill=tk.X)#.grid(column=0, row=3)
+            self.leftcolumn, text='Background', command=self.update_stock_img, padx=30, pady=5, bg='grey', state=tk.DISABLED)
+        self._drawStockImg.pack(fill=tk.X)#.grid(column=0, row=3)
         self._drawGrid = tk.Button(
-            self.leftcolumn, text='Grid', command=self.update_gridlines, padx=30, pady=5, bg='grey').pack(fill=tk.X)  # .grid(column=0, row=4)
+            self.leftcolumn, text='Grid', command=self.update_gridlines, padx=30, pady=5, bg='grey', state=tk.DISABLED)
+        self._drawGrid.pack(fill=tk.X)  # .grid(column=0, row=4)
         self._drawTissot = tk.Button(
-            self.leftcolumn, text='Tissot', command=self.update_tissot, padx=30, pady=5, bg='grey').pack(fill=tk.X)  # .grid(column=0, row=5)
+            self.leftcolumn, text='Tissot', command=self.update_tissot, padx=30, pady=5, bg='grey', state=tk.DISABLED)
+        self._drawTissot.pack(fill=tk.X)  # .grid(column=0, row=5)
         self.dropdown_projections()
         
         tk.Label(self.leftcolumn, text=' ', bg='grey').pack(fill=tk.X)
-        self._getForecastButton = tk.Button(self.leftcolumn, text='Load forecast', command=self.load_arome, padx=30, pady=5, bg='red')
+        self._getForecastButton = tk.Button(self.leftcolumn, text='Load forecast', command=self.load_arome, padx=30, pady=5, bg='red',
+                                            state=tk.DISABLED)
         self._getForecastButton.pack(fill=tk.X)  # .grid(column=0, row=5)
-
+        self.map_buttons = [self._drawCoastlinesButton, self._drawStockImg, self._drawGrid, self._drawTissot,
+                            self.dropButton, self._getForecastButton]
+
+        #Breakdown of the last render, only shown while tracing
+        if tracer.enabled:
+            self.statusBar = tk.Label(self.Window, anchor='w', text='')
+            self.statusBar.pack(side=tk.BOTTOM, fill=tk.X)
+            self.update_status()
         self.leftcolumn.pack(side=tk.LEFT, fill=tk.BOTH, expand=False)
 
+    def update_status(self):
+        self.statusBar['text'] = tracer.summary(STAGES)
+        self.Window.after(250, self.update_status)
+
     def reset_parameters(self):
         self.coast = None
         self.stock_img = None
         self.gridlines = None
         self.tissot = None
+        self.contour = None
+        self.drawn = None
+        self.cax = None
+        self.background = None
 
     def load_arome(self):
-        url = 'https://thredds.met.no/thredds/dodsC/mepslatest/meps_det_vc_2_5km_latest.nc'
-        self.forecast = xr.open_dataset(url)
-        self.variables = [name for name in self.forecast.variables.keys()]
+        from concurrent.futures import ThreadPoolExecutor
+        #Opening the dataset and fetching its grid can take seconds over OPeNDAP, so it runs on a thread
+        #and poll_arome sets up the widgets once it is done
+        self._getForecastButton["state"] = tk.DISABLED
+        self._getForecastButton["text"] = 'Loading forecast...'
+        pool = ThreadPoolExecutor(max_workers=1)
+        self.opening = pool.submit(self.open_source)
+        pool.shutdown(wait=False)
+        self.poll_arome()
+
+    def open_source(self):
+        '''
+        (loader, catalog, statistics, args) of the forecast, where statistics(*args) fills in the
+        catalog's full statistics. Runs off the Tk thread.
+        '''
+        from loader import SubsetLoader, ChunkCache, MEPS_URL
+        from catalog import open_catalog, source_version
+        source = self.source or MEPS_URL
+        with span('load_arome'):
+            if self.server is not None:
+                #Slices come from a field server shared with the other sessions on this machine
+                from fieldserver import FieldClient
+                loader = FieldClient(self.server)
+                return loader, loader.catalog, loader.wait_statistics, ()
+            loader = SubsetLoader(source, cache=ChunkCache())
+            catalog, catalog_path = open_catalog(loader.dataset, source, source_version(source) or loader.run_time, stats=False)
+            return loader, catalog, catalog.add_statistics, (loader.dataset, None, catalog_path)
+
+    def poll_arome(self):
+        from prefetch import Prefetcher
+        if not self.opening.done():
+            self.Window.after(50, self.poll_arome)
+            return
+        if self.opening.exception() is not None:
+            self._getForecastButton["state"] = tk.NORMAL
+            self._getForecastButton["text"] = 'Load forecast'
+            raise self.opening.exception()
+        self.loader, self.catalog, statistics, args = self.opening.result()
+        if self.server is None:
+            self.forecast = self.loader.dataset
+        #Contour levels come from the ranges of the slices read for display, the prefetched neighbours included
+        self.prefetcher = Prefetcher(self.loader, observe=self.catalog.observe)
+        self.variables = list(self.catalog.variables)
+        #The full statistics read every field in full and compete with the prefetcher for the dataset, so only on request
+        if self.statistics:
+            threading.Thread(target=statistics, args=args, daemon=True).start()
         self.dropdown_arome()
-        self.lat = self.forecast.variables['latitude'][0, :]
-        self.lon = self.forecast.variables['longitude'][0, :]
-        #self.LON, self.LAT = np.meshgrid(self.lon, self.lat)
+        self.lat = self.loader.lat
+        self.lon = self.loader.lon
 
-        self._getForecastButton["state"] = tk.DISABLED
+        self._getForecastButton["text"] = 'Load forecast'
         self.aromeExtentButton = tk.Button(self.leftcolumn, text='Use AROME extent', command=self.set_arome_extent, pady=5, padx=30).pack(fill=tk.X, side=tk.BOTTOM)
         
         plotLevelFrame = tk.Frame(self.leftcolumn)
@@ -79,6 +165,36 @@ class DianaProgram:
         self.cmapInput.pack(side=tk.RIGHT, fill=tk.X)
         cmapFrame.pack(fill=tk.X)
 
+        stepFrame = tk.Frame(self.leftcolumn)
+        tk.Button(stepFrame, text='<', command=lambda: self.step_time(-1)).pack(side=tk.LEFT)
+        tk.Button(stepFrame, text='>', command=lambda: self.step_time(1)).pack(side=tk.LEFT)
+        self.stepLabel = tk.Label(stepFrame, text='t=0 h=0')
+        self.stepLabel.pack(side=tk.LEFT, fill=tk.X, expand=True)
+        tk.Button(stepFrame, text='v', command=lambda: self.step_level(-1)).pack(side=tk.RIGHT)
+        tk.Button(stepFrame, text='^', command=lambda: self.step_level(1)).pack(side=tk.RIGHT)
+        stepFrame.pack(fill=tk.X)
+
+        self.modeButton = tk.Button(self.leftcolumn, text='Raster', command=self.update_render_mode, padx=30, pady=5)
+        self.modeButton.pack(fill=tk.X)
+
+    def update_render_mode(self):
+        #Raster draws a precomputed-weight image, much faster than filled contours when stepping.
+        #Tiles are rendered once per zoom level and reused while panning and zooming
+        modes = ['contour', 'raster', 'tiles']
+        self.render_mode = modes[(modes.index(self.render_mode) + 1) % 3]
+        self.modeButton['text'] = modes[(modes.index(self.render_mode) + 1) % 3].capitalize()
+        self.plot_variable()
+
+    def step_time(self, n):
+        ntimes, _ = self.loader.steps(self.click_arome.get())
+        self.timestep = min(max(self.timestep + n, 0), ntimes - 1)
+        self.plot_variable()
+
+    def step_level(self, n):
+        _, nlevels = self.loader.steps(self.click_arome.get())
+        self.heightstep = min(max(self.heightstep + n, 0), nlevels - 1)
+        self.plot_variable()
+
     def update_plot_levels(self, _):
         self.plotlevels = int(self.inputPlotLevels.get())
         self.plot_variable()
@@ -88,39 +204,162 @@ class DianaProgram:
         self.plot_variable()
 
     def set_arome_extent(self):
+        import cartopy.crs as ccrs, numpy as np
         self.arome_min_lat, self.arome_max_lat = np.amin(self.lat), np.amax(self.lat)
         self.arome_min_lon, self.arome_max_lon = np.amin(self.lon), np.amax(self.lon)
         self.coordinates = [self.arome_min_lon, self.arome_max_lon, self.arome_min_lat, self.arome_max_lat]
+        self.geometry.invalidate()
         self.map.set_extent(self.coordinates, crs=ccrs.PlateCarree())
+        self.refresh_features(force=True)
         self.update_map()
 
     def plot_variable(self):
+        #Reads happen on the prefetcher threads, poll_variable picks the slice up on the Tk thread
+        #Stages from earlier renders are dropped so the status bar shows this one
+        tracer.last.clear()
         self.var_to_plot = self.click_arome.get()
-
+        self.stepLabel['text'] = f't={self.timestep} h={self.heightstep}'
+        if self.render_mode == 'tiles':
+            self.show_tiles()
+            return
+        if self.tiles is not None:
+            self.tiles.clear()
+        self.read_variable()
+
+    def read_variable(self):
+        from render import visible_extent
+        #Only the visible window is read, refresh_view reads again once the view leaves it
+        self.pending = (self.var_to_plot, self.timestep, self.heightstep, visible_extent(self.map))
+        self.drawn = (self.pending[3], tuple(self.map.get_extent()))
+        self.prefetcher.prefetch(*self.pending)
+        self.poll_variable()
+
+    def field_outdated(self):
+        '''
+        True when the view has left the window the current slice was read for. A raster is also
+        resampled for the pixels of each new view.
+        '''
+        from render import visible_extent
+        if self.drawn is None or self.render_mode == 'tiles':
+            return False
+        extent, view = self.drawn
+        if self.render_mode == 'raster' and view != tuple(self.map.get_extent()):
+            return True
+        x0, x1, y0, y1 = visible_extent(self.map)
+        return not (extent[0] <= x0 and x1 <= extent[1] and extent[2] <= y0 and y1 <= extent[3])
+
+    def poll_variable(self):
+        if self.pending is None:
+            return
+        loaded = self.prefetcher.get(*self.pending)
+        if loaded is None:
+            self.Window.after(50, self.poll_variable)
+            return
+        extent, self.pending = self.pending[3], None
+        if self.render_mode == 'tiles':
+            from tiles import tile_levels
+            levels = self.contour_levels()
+            self.start_tiles(tile_levels(loaded[0], self.plotlevels) if isinstance(levels, int) else levels)
+            return
+        self.draw_variable(*loaded, extent)
+
+    def draw_variable(self, variable, lon, lat, extent):
+        from render import draw_field, draw_raster, map_raster
         try:
             self.contour.remove()
         except:
             pass
+        self.contour = None
+
+        if self.render_mode == 'raster':
+            raster = map_raster(self.map, self.geometry, lon, lat, extent)
+            with span('raster'):
+                self.contour = draw_raster(self.map, raster, variable, self.contour_levels(), self.cmap)
+        else:
+            geometry = self.geometry.get(lon, lat, self.map.projection, extent)
+            with span('contour'):
+                self.contour = draw_field(self.map, geometry, variable, self.contour_levels(), self.cmap)
+        self.contour.set_animated(True)
+        with span('colorbar'):
+            self.draw_colorbar(self.contour)
+        self.update_layers()
+
+    def contour_levels(self):
+        #Levels over all timesteps once the catalog has the variable, so they stay put while stepping
+        levels = self.catalog.contour_levels(self.var_to_plot, self.plotlevels, levels=self.heightstep)
+        return self.plotlevels if levels is None else levels
+
+    def draw_colorbar(self, mappable):
+        #The colorbar axes is made once, later colorbars are drawn into it without changing the layout
+        if self.cax is None:
+            self.cbar = self.fig.colorbar(mappable, ax=self.map, orientation='horizontal', location='bottom')
+            self.cax = self.cbar.ax
+            self.cax.set_animated(True)
+            self.background = None
+        else:
+            self.cax.clear()
+            self.cbar = self.fig.colorbar(mappable, cax=self.cax, orientation='horizontal')
+
+    def show_tiles(self):
+        from render import visible_extent
+        self.pending = None
         try:
-            self.cbar.remove()
+            self.contour.remove()
         except:
             pass
-
-        if self.var_to_plot is not None:
-            if len(self.forecast.variables[self.var_to_plot][1]) > 3:
-                variable = self.forecast.variables[self.var_to_plot][self.timestep, self.heightstep, 0, :]
-            else:
-                variable = self.forecast.variables[self.var_to_plot][self.timestep, self.heightstep, 0, :]
-
-            self.contour = self.map.tricontourf(self.lon, self.lat, variable, levels=self.plotlevels, transform=ccrs.PlateCarree(), alpha=0.5, cmap=self.cmap)
-            self.cbar = self.fig.colorbar(self.contour, ax=self.map, orientation='horizontal', location='bottom')
-        
+        self.contour = None
+
+        levels = self.contour_levels()
+        if isinstance(levels, int):
+            #Tiles need fixed levels. Without a known range they come from the visible slice, read on the prefetcher
+            self.pending = (self.var_to_plot, self.timestep, self.heightstep, visible_extent(self.map))
+            self.prefetcher.prefetch(*self.pending)
+            self.poll_variable()
+            return
+        self.start_tiles(levels)
+
+    def start_tiles(self, levels):
+        from tiles import TileCache, TileLayer
+        if self.tile_cache is None:
+            self.tile_cache = TileCache()
+        if self.tiles is None:
+            self.tiles = TileLayer(self.map, self.loader, self.proj, self.tile_cache)
+        self.tiles.show(self.var_to_plot, self.timestep, self.heightstep, self.cmap, levels)
+        self.draw_colorbar(self.tiles.mappable)
+        self.update_map()
+        self.poll_tiles()
+
+    def poll_tiles(self):
+        if self.tiles is None:
+            return
+        #Tiles are part of the background, so a finished tile means a full redraw
+        if self.tiles.poll():
+            self.update_map()
+        if self.tiles.pending:
+            self.Window.after(50, self.poll_tiles)
+
+    def view_changed(self, _):
+        #Pan and zoom change xlim and ylim together, refresh the layers once for both
+        if self.view_pending:
+            return
+        self.view_pending = True
+        self.Window.after_idle(self.refresh_view)
+
+    def refresh_view(self):
+        self.view_pending = False
+        self.refresh_features()
+        if self.field_outdated():
+            #Nearby windows come from the chunk cache or the prefetcher
+            self.read_variable()
+        if self.tiles is not None:
+            self.tiles.refresh()
+            self.poll_tiles()
         self.update_map()
-
 
     def dropdown_arome(self):
-        self.options = [var for var in self.variables if len(
-            self.forecast.variables[var].shape) >= 3]
+        from derived import available
+        #Derived variables are listed after the raw fields and computed only over the plotted slice
+        self.options = self.catalog.fields() + available(self.catalog.variables)
         self.click_arome = tk.StringVar()
         self.click_arome.set(self.options[0])
         drop_arome = tk.OptionMenu(self.leftcolumn, self.click_arome, *self.options)
@@ -134,38 +373,67 @@ class DianaProgram:
         self.click.set(self.all_projections[0])
         self.drop = tk.OptionMenu(self.leftcolumn, self.click, *self.all_projections)
         self.drop.pack(fill=tk.X)
-        self.dropButton = tk.Button(self.leftcolumn, text='Project', command=self.update_projection, padx=30, pady=5)
+        self.dropButton = tk.Button(self.leftcolumn, text='Project', command=self.update_projection, padx=30, pady=5, state=tk.DISABLED)
         self.dropButton.pack(fill=tk.X)
     
     def redraw_map(self):
-        plt.clf()
-        try:
-            self.plotframe.destroy()
-        except:
-            pass
+        with span('redraw_map'):
+            self.build_map()
+        self.update_map()
 
+    def build_map(self):
+        from matplotlib import rcParams
+        from matplotlib.figure import Figure
+        from matplotlib.backends.backend_tkagg import FigureCanvasTkAgg, NavigationToolbar2Tk
         self.reset_parameters()
+        if self.tiles is not None:
+            self.tiles.shutdown()
+            self.tiles = None
 
-        projection = getattr(ccrs, self.proj)
-
-        self.fig = plt.Figure(figsize=(3/3 * self.window_width * self.dpi, self.window_height * self.dpi))
-        self.map = self.fig.add_subplot(111, projection=projection())
+        #Frame, canvas and toolbar are made once, a new projection only replaces the axes
+        try:
+            self.fig.clf()
+        except AttributeError:
+            self.dpi = 1/rcParams['figure.dpi']
+            self.fig = Figure(figsize=(3/3 * self.window_width * self.dpi, self.window_height * self.dpi))
+            self.plotframe = tk.Frame(self.Window)
+            self.plotframe.pack(side=tk.RIGHT, fill=tk.BOTH, expand=True)
+            self.canvas = FigureCanvasTkAgg(self.fig, master=self.plotframe)
+            #Agg rendering of the whole figure, including the draws scheduled by draw_idle
+            self.canvas.draw = tracer.wrap('canvas.draw', self.canvas.draw)
+            self.canvas.get_tk_widget().pack(fill=tk.BOTH, side=tk.TOP, expand=True)
+            NavigationToolbar2Tk(self.canvas, self.plotframe).pack(side=tk.BOTTOM)
+            self.canvas.mpl_connect('draw_event', self.on_draw)
+
+        self.map = self.fig.add_subplot(111, projection=get_projection(self.proj))
+        self.map.callbacks.connect('xlim_changed', self.view_changed)
+        self.map.callbacks.connect('ylim_changed', self.view_changed)
         self.fig.tight_layout(pad=0, h_pad=None, w_pad=None, rect=None)
 
-        self.update_map()
-
     def update_map(self):
-        try:
-            self.plotframe.destroy()
-        except:
-            pass
-        self.plotframe = tk.Frame(self.Window)
-        self.plotframe.pack(side=tk.RIGHT, fill=tk.BOTH, expand=True)
-
-        self.canvas = FigureCanvasTkAgg(self.fig, master=self.plotframe)
-        self.canvas.draw()
-        self.canvas.get_tk_widget().pack(fill=tk.BOTH, side=tk.TOP, expand=True)
-        NavigationToolbar2Tk(self.canvas, self.plotframe).pack(side=tk.BOTTOM)
+        #Static layers changed, the next draw captures a new background
+        self.background = None
+        self.canvas.draw_idle()
+
+    def update_layers(self):
+        #Only the contour layer changed, repaint it on top of the cached background
+        if self.background is None:
+            self.canvas.draw_idle()
+            return
+        with span('blit'):
+            self.canvas.restore_region(self.background)
+            self.draw_layers()
+            self.canvas.blit(self.fig.bbox)
+
+    def draw_layers(self):
+        if self.contour is not None:
+            self.map.draw_artist(self.contour)
+        if self.cax is not None:
+            self.fig.draw_artist(self.cax)
+
+    def on_draw(self, _):
+        self.background = self.canvas.copy_from_bbox(self.fig.bbox)
+        self.draw_layers()
 
     def get_map_extent(self):
         self.coordFrame = tk.Frame(self.leftcolumn)
@@ -225,12 +493,35 @@ class DianaProgram:
             self.coordinates[3] = input
         except:
             pass
+        import cartopy.crs as ccrs
         self.map.set_extent(self.coordinates, crs=ccrs.PlateCarree())
+        self.refresh_features(force=True)
+        self.view_changed(self.map)
         self.update_map()
 
+    def draw_feature(self, name):
+        #Projected and clipped to the current view once, later toggles and projections come from the cache
+        from features import draw_coastlines, draw_stock_img
+        from render import visible_extent
+        draw = draw_coastlines if name == 'coast' else draw_stock_img
+        self.feature_views[name] = self.map.get_extent()
+        return draw(self.map, self.features, visible_extent(self.map))
+
+    def refresh_features(self, force=False):
+        #Layers are redrawn once the view leaves the one they were clipped to, zooming in keeps them
+        x0, x1, y0, y1 = self.map.get_extent()
+        for name in ('coast', 'stock_img'):
+            layer = getattr(self, name)
+            if layer is None:
+                continue
+            b0, b1, c0, c1 = self.feature_views[name]
+            if force or x0 < b0 or x1 > b1 or y0 < c0 or y1 > c1:
+                layer.remove()
+                setattr(self, name, self.draw_feature(name))
+
     def update_coast(self):
         if self.coast is None:
-            self.coast = self.map.coastlines()
+            self.coast = self.draw_feature('coast')
         else:
             self.coast.remove()
             self.coast = None
@@ -238,7 +529,7 @@ class DianaProgram:
 
     def update_stock_img(self):
         if self.stock_img is None:
-            self.stock_img = self.map.stock_img()
+            self.stock_img = self.draw_feature('stock_img')
         else:
             self.stock_img.remove()
             self.stock_img = None
@@ -262,6 +553,7 @@ class DianaProgram:
 
     def update_projection(self):
         self.proj = self.click.get()
+        self.geometry.invalidate()
         self.redraw_map()
 
     @property
@@ -273,18 +565,80 @@ class DianaProgram:
         return self.Window.winfo_width()
 
     def from_plot_to_PIL(self, fig):
+        from PIL import Image
         buf = io.BytesIO()
         fig.savefig(buf)
         buf.seek(0)
-        img = PIL.Image.open(buf)
+        img = Image.open(buf)
         return img
 
-    def run(self):
-        self.redraw_map()
+    def run(self, startup_check=False):
+        #The window is shown first, matplotlib and cartopy are imported on a thread meanwhile
+        self.startup_check = startup_check
+        self.loading = threading.Thread(target=import_heavy_modules, daemon=True)
+        self.loading.start()
+        self.Window.after(0, self.window_shown)
         self.Window.mainloop()
-
-
-diana = DianaProgram().run()
+        try:
+            self.prefetcher.shutdown()
+        except AttributeError:
+            pass
+        if self.tiles is not None:
+            self.tiles.shutdown()
+
+    def window_shown(self):
+        self.Window.update_idletasks()
+        self.window_time = time.perf_counter() - started
+        self.finish_startup()
+
+    def finish_startup(self):
+        if self.loading.is_alive():
+            self.Window.after(20, self.finish_startup)
+            return
+        from geometry import GeometryCache
+        from features import FeatureCache
+        self.geometry = GeometryCache()
+        self.features = FeatureCache()
+        self.redraw_map()
+        for button in self.map_buttons:
+            button['state'] = tk.NORMAL
+        self.map_time = time.perf_counter() - started
+        if self.startup_check:
+            print(f'window shown after {self.window_time:.2f} s, map ready after {self.map_time:.2f} s, target {STARTUP_TARGET:.2f} s')
+            self.Window.destroy()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Diana weather map viewer.')
+    parser.add_argument('--source', default=None, help='OPeNDAP url or NetCDF file, default is the latest MEPS run')
+    parser.add_argument('--startup-check', action='store_true', help='report startup time and fail above the target')
+    parser.add_argument('--trace', default=None, help='time each stage, show it in a status bar and write a Chrome trace here on exit')
+    parser.add_argument('--profile', default=None, help='write cProfile stats of the GUI thread here on exit')
+    parser.add_argument('--statistics', action='store_true',
+                        help='compute min/max of every field in the background for fixed contour levels, reads the whole dataset')
+    parser.add_argument('--server', nargs='?', const='', default=None,
+                        help='read through a running fieldserver.py, optionally at this socket path or host:port')
+    args = parser.parse_args(argv)
+
+    if args.trace or args.profile:
+        tracer.enable(profile=args.profile is not None)
+    server = None
+    if args.server is not None:
+        from fieldserver import parse_address
+        server = parse_address(args.server or None)
+    diana = DianaProgram(source=args.source, server=server, statistics=args.statistics)
+    diana.run(startup_check=args.startup_check)
+    if args.trace:
+        tracer.save(args.trace)
+    if args.profile:
+        tracer.save_profile(args.profile)
+    if args.startup_check and diana.window_time > STARTUP_TARGET:
+        return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
 
 
 
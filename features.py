@@ -0,0 +1,146 @@
+from collections import OrderedDict
+from matplotlib.collections import PathCollection
+from matplotlib.path import Path
+from cartopy.mpl.path import shapely_to_path
+from loader import ChunkCache
+from timing import span
+import cartopy, cartopy.crs as ccrs, cartopy.feature as cfeature, numpy as np, os, shapely
+
+FEATURES_DIR = os.path.join(os.path.expanduser('~'), '.cache', 'diana', 'features')
+STOCK_IMAGE = os.path.join(cartopy.config['repo_data_dir'], 'raster', 'natural_earth', '50-natural-earth-1-downsampled.png')
+#Coarsest first, a resolution that cannot be loaded falls back to the next coarser one
+RESOLUTIONS = ['110m', '50m', '10m']
+
+
+def resolution_for_extent(extent):
+    '''
+    Natural Earth scale for a [min_lon, max_lon, min_lat, max_lat] box: 110m for continents, 10m for a fjord.
+    '''
+    span = max(extent[1] - extent[0], extent[3] - extent[2])
+    return '110m' if span > 60 else '50m' if span > 15 else '10m'
+
+
+def clip_box(extent, margin=1.0):
+    min_lon, max_lon, min_lat, max_lat = extent
+    return (max(min_lon - margin, -180), max(min_lat - margin, -90), min(max_lon + margin, 180), min(max_lat + margin, 90))
+
+
+class FeatureCache:
+    '''
+    Coastlines and the stock background image projected and clipped to a map view once, kept
+    least recently used first in memory and in a ChunkCache on disk. Keyed on
+    (kind, projection, view, resolution), so switching back to a projection skips the reprojection.
+    Parameters:
+    -----------
+    maxsize   - layers kept in memory
+    directory - on-disk cache, None keeps layers in memory only
+    '''
+    def __init__(self, maxsize=16, directory=FEATURES_DIR, max_bytes=256 * 2**20):
+        self.maxsize = maxsize
+        self.entries = OrderedDict()
+        self.disk = None if directory is None else ChunkCache(directory, max_bytes)
+        self.stock = None
+
+    def cached(self, key, compute):
+        if key in self.entries:
+            self.entries.move_to_end(key)
+            return self.entries[key]
+        array = None if self.disk is None else self.disk.get(key)
+        if array is None:
+            array = compute()
+            if self.disk is not None:
+                self.disk.put(key, array)
+        self.entries[key] = array
+        while len(self.entries) > self.maxsize:
+            self.entries.popitem(last=False)
+        return array
+
+    @staticmethod
+    def key(kind, projection, bounds, extent, *rest):
+        #WKT rather than the CRS object, the disk key has to be the same in the next session
+        return (kind, projection.to_wkt(), tuple(round(float(b), 3) for b in bounds), tuple(extent)) + rest
+
+    def coastlines(self, projection, bounds, extent):
+        '''
+        Path of the coastlines inside extent = [min_lon, max_lon, min_lat, max_lat], in the
+        coordinates of projection, clipped to bounds = (x0, x1, y0, y1) of the view.
+        '''
+        resolution = resolution_for_extent(extent)
+        key = self.key('coastlines', projection, bounds, extent, resolution)
+        packed = self.cached(key, lambda: self.project_coastlines(projection, bounds, extent, resolution))
+        #Vertices and path codes are stored as one array of (x, y, code) rows
+        return Path(packed[:, :2], packed[:, 2].astype(np.uint8)) if len(packed) else None
+
+    @staticmethod
+    def project_coastlines(projection, bounds, extent, resolution):
+        with span('coastlines', resolution=resolution):
+            box = clip_box(extent)
+            for scale in RESOLUTIONS[RESOLUTIONS.index(resolution)::-1]:
+                try:
+                    geometries = list(cfeature.COASTLINE.with_scale(scale).geometries())
+                    break
+                except OSError:
+                    continue
+            else:
+                return np.zeros((0, 3))
+
+            #Only what is near the view is projected
+            clipped = [shapely.clip_by_rect(geometry, *box) for geometry in geometries]
+            clipped = [geometry for geometry in clipped if not geometry.is_empty]
+            view = shapely.box(bounds[0], bounds[2], bounds[1], bounds[3])
+            paths = []
+            for geometry in clipped:
+                projected = projection.project_geometry(geometry, ccrs.PlateCarree()).intersection(view)
+                if not projected.is_empty:
+                    paths.append(shapely_to_path(projected))
+            paths = [path for path in paths if len(path.vertices)]
+            if not paths:
+                return np.zeros((0, 3))
+            path = Path.make_compound_path(*paths)
+            codes = path.codes if path.codes is not None else np.full(len(path.vertices), Path.LINETO)
+            return np.column_stack([path.vertices, codes]).astype(float)
+
+    def stock_image(self, projection, bounds, extent, shape):
+        '''
+        RGBA background image of the view bounds = (x0, x1, y0, y1) with shape = (ny, nx) pixels,
+        warped from the part of the global image inside extent. Rows run south to north.
+        '''
+        key = self.key('stock_img', projection, bounds, extent, tuple(shape))
+        return self.cached(key, lambda: self.warp_stock_image(projection, bounds, extent, shape))
+
+    def warp_stock_image(self, projection, bounds, extent, shape):
+        from cartopy.img_transform import warp_array
+        from matplotlib.image import imread
+        with span('stock_img'):
+            if self.stock is None:
+                #Rows flipped to run south to north, as warp_array expects. PNGs are read as floats in [0, 1]
+                self.stock = (imread(STOCK_IMAGE)[::-1, :, :3] * 255).astype(np.uint8)
+            ny, nx = self.stock.shape[:2]
+            min_lon, min_lat, max_lon, max_lat = clip_box(extent)
+            x0, x1 = int(np.floor((min_lon + 180) / 360 * nx)), int(np.ceil((max_lon + 180) / 360 * nx))
+            y0, y1 = int(np.floor((min_lat + 90) / 180 * ny)), int(np.ceil((max_lat + 90) / 180 * ny))
+            source = self.stock[y0:y1, x0:x1]
+            source_extent = [x0 / nx * 360 - 180, x1 / nx * 360 - 180, y0 / ny * 180 - 90, y1 / ny * 180 - 90]
+
+            image, _ = warp_array(source, projection, ccrs.PlateCarree(), (shape[1], shape[0]), source_extent,
+                                  bounds, mask_extrapolated=True)
+            alpha = np.where(np.ma.getmaskarray(image).any(axis=-1), 0, 255).astype(np.uint8)
+            return np.dstack([np.ma.filled(image, 0).astype(np.uint8), alpha])
+
+
+def draw_coastlines(map, cache, extent, color='black', linewidth=0.8):
+    '''
+    Cached coastlines of a map axes as one PathCollection, removed with .remove() like map.coastlines().
+    '''
+    path = cache.coastlines(map.projection, map.get_extent(), extent)
+    collection = PathCollection([] if path is None else [path], facecolor='none', edgecolor=color, linewidth=linewidth,
+                                transform=map.transData, zorder=1.5)
+    map.add_collection(collection, autolim=False)
+    return collection
+
+
+def draw_stock_img(map, cache, extent):
+    shape = (max(int(map.bbox.height), 1), max(int(map.bbox.width), 1))
+    bounds = map.get_extent()
+    image = cache.stock_image(map.projection, bounds, extent, shape)
+    return map.imshow(image, extent=bounds, origin='lower', transform=map.projection, interpolation='nearest', zorder=0)
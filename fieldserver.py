@@ -0,0 +1,358 @@
+'''
+Local field server: one process opens a forecast and publishes the slices it reads as .npy files
+in shared memory (/dev/shm where there is one). Diana sessions and batch jobs on the same machine
+connect with FieldClient, which behaves like a SubsetLoader, and map the published slices
+read-only instead of fetching their own copy.
+
+    python fieldserver.py --source meps.nc
+    python diana.py --server
+'''
+from collections import OrderedDict
+from multiprocessing import AuthenticationError
+from multiprocessing.connection import Listener, Client
+from loader import SubsetLoader, ChunkCache, MEPS_URL
+from catalog import Catalog, open_catalog, source_version
+import numpy as np, argparse, hashlib, os, shutil, signal, socket, sys, tempfile, threading
+
+CACHE_DIR = os.path.join(os.path.expanduser('~'), '.cache', 'diana')
+#A Unix socket readable by the user only where there is one, otherwise loopback TCP
+ADDRESS = os.path.join(CACHE_DIR, 'fields.sock') if hasattr(socket, 'AF_UNIX') else ('localhost', 47100)
+#Random key made on first use, readable by the user only. Messages are pickles, the key is what keeps others out
+AUTHKEY_FILE = os.path.join(CACHE_DIR, 'fields.key')
+LOOPBACK = ('localhost', '127.0.0.1', '::1')
+#tmpfs, so the published slices never touch the disk
+SHARED_DIR = '/dev/shm' if os.path.isdir('/dev/shm') else tempfile.gettempdir()
+
+
+def load_authkey(path=AUTHKEY_FILE):
+    '''
+    Key shared by the server and the clients of this user, created with mode 0600 on first use.
+    '''
+    try:
+        with open(path, 'rb') as f:
+            return f.read()
+    except FileNotFoundError:
+        pass
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    try:
+        fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600)
+    except FileExistsError:
+        #Made by another process meanwhile
+        with open(path, 'rb') as f:
+            return f.read()
+    key = os.urandom(32)
+    with os.fdopen(fd, 'wb') as f:
+        f.write(key)
+    return key
+
+
+def check_address(address, allow_remote=False):
+    #Slices are shared through local files, a remote client has no use for the server
+    if not isinstance(address, str) and address[0] not in LOOPBACK and not allow_remote:
+        raise ValueError(f'refusing to listen on {address[0]}, only loopback addresses are allowed without allow_remote')
+    return address
+
+
+class Segment:
+    __slots__ = ('path', 'nbytes', 'refs', 'window')
+
+    def __init__(self, path, nbytes, window, refs=1):
+        self.path = path
+        self.nbytes = nbytes
+        self.window = window
+        self.refs = refs
+
+
+class FieldServer:
+    '''
+    Opens source once and serves (var, time, level, extent) slices to any number of clients. Each
+    slice is decoded once and written to a file in shared memory that the clients memory-map.
+    Slices are reference counted per client and the unreferenced ones are evicted least recently
+    used first once they take up more than max_bytes.
+    Parameters:
+    -----------
+    source       - url or file path, as for SubsetLoader
+    address      - Unix socket path or (host, port) to listen on
+    max_bytes    - shared memory kept for slices no client holds
+    directory    - where the slice files are written, default is a directory of this server in /dev/shm
+    authkey      - key clients must present, default is the key in AUTHKEY_FILE
+    allow_remote - listen on a TCP address other than loopback
+    statistics   - compute the statistics of every field in the background, which reads the whole dataset
+    '''
+    def __init__(self, source=MEPS_URL, address=ADDRESS, max_bytes=1024 * 2**20, directory=None, authkey=None,
+                 allow_remote=False, statistics=False):
+        self.source = source
+        self.address = check_address(address, allow_remote)
+        self.max_bytes = max_bytes
+        self.directory = directory or os.path.join(SHARED_DIR, f'diana-fields-{os.getpid()}')
+        os.makedirs(self.directory, exist_ok=True)
+        self.loader = SubsetLoader(source, cache=ChunkCache())
+        self.catalog, self.catalog_path = open_catalog(self.loader.dataset, source,
+                                                       source_version(source) or self.loader.run_time, stats=False)
+        self.statistics = None
+        if statistics:
+            self.statistics = threading.Thread(target=self.catalog.add_statistics,
+                                               args=(self.loader.dataset, None, self.catalog_path), daemon=True)
+        self.lock = threading.Lock()
+        self.segments = OrderedDict()
+        self.pending = {}
+        self.size = 0
+        #The grid is held by the server itself and never evicted
+        self.grid = [self.publish(('grid', name), array, None).path
+                     for name, array in (('lat', self.loader.lat), ('lon', self.loader.lon))]
+
+        if isinstance(address, str) and os.path.exists(address):
+            os.remove(address)
+        if isinstance(address, str):
+            os.makedirs(os.path.dirname(os.path.abspath(address)), exist_ok=True)
+        self.listener = Listener(address, authkey=authkey or load_authkey())
+        if isinstance(address, str):
+            os.chmod(address, 0o600)
+
+    def info(self):
+        #Statistics gathered so far, copied since the statistics thread adds to them
+        catalog = Catalog(self.catalog.version, self.catalog.variables, dict(self.catalog.stats))
+        return {'source': self.source, 'run_time': self.loader.run_time, 'grid': self.grid, 'catalog': catalog}
+
+    def publish(self, key, values, window):
+        '''
+        Write values to shared memory as a segment held once by the caller.
+        '''
+        path = os.path.join(self.directory, hashlib.sha1(repr(key).encode()).hexdigest() + '.npy')
+        #Written under another name and renamed, a client never maps a half-written file
+        np.save(path + '.part.npy', np.ascontiguousarray(values))
+        os.replace(path + '.part.npy', path)
+        segment = Segment(path, os.path.getsize(path), window)
+        with self.lock:
+            self.segments[key] = segment
+            self.size += segment.nbytes
+            self.evict()
+        return segment
+
+    def acquire(self, var, time, level, extent):
+        '''
+        Segment of the slice with its reference count raised, read and published on the first request.
+        Concurrent requests for a slice that is being read wait for that read.
+        '''
+        window = self.loader.window(extent)
+        key = (var, time, level, window)
+        while True:
+            with self.lock:
+                if key in self.segments:
+                    segment = self.segments[key]
+                    segment.refs += 1
+                    self.segments.move_to_end(key)
+                    return key, segment
+                event = self.pending.get(key)
+                if event is None:
+                    self.pending[key] = threading.Event()
+                    break
+            event.wait()
+
+        try:
+            values, _, _ = self.loader.read(var, time, level, extent)
+            segment = self.publish(key, values, window)
+        finally:
+            with self.lock:
+                self.pending.pop(key).set()
+        return key, segment
+
+    def release(self, key):
+        with self.lock:
+            segment = self.segments.get(key)
+            if segment is not None and segment.refs > 0:
+                segment.refs -= 1
+            self.evict()
+
+    def evict(self):
+        #Called with the lock held. Files still mapped by a client stay valid after the unlink
+        for key in [key for key, segment in self.segments.items() if segment.refs == 0]:
+            if self.size <= self.max_bytes:
+                break
+            segment = self.segments.pop(key)
+            self.size -= segment.nbytes
+            try:
+                os.remove(segment.path)
+            except OSError:
+                pass
+
+    def handle(self, connection):
+        held = {}
+        try:
+            while True:
+                request = connection.recv()
+                try:
+                    if request[0] == 'info':
+                        reply = self.info()
+                    elif request[0] == 'read':
+                        key, segment = self.acquire(*request[1:])
+                        held[key] = held.get(key, 0) + 1
+                        reply = key, segment.path, segment.window
+                    elif request[0] == 'release':
+                        if held.get(request[1], 0) > 0:
+                            held[request[1]] -= 1
+                            self.release(request[1])
+                        continue
+                    elif request[0] == 'statistics':
+                        #Without the background pass this is whatever the sidecar had
+                        if self.statistics is not None:
+                            self.statistics.join()
+                        reply = dict(self.catalog.stats)
+                    else:
+                        raise ValueError(f'unknown request {request[0]!r}')
+                except Exception as error:
+                    reply = error
+                connection.send(reply)
+        except (EOFError, OSError):
+            pass
+        finally:
+            #Whatever a client still held when it went away is released
+            for key, count in held.items():
+                for _ in range(count):
+                    self.release(key)
+            connection.close()
+
+    def serve_forever(self):
+        if self.statistics is not None:
+            self.statistics.start()
+        try:
+            while True:
+                try:
+                    connection = self.listener.accept()
+                except AuthenticationError:
+                    #A client without the key is turned away, the server keeps going
+                    continue
+                except OSError:
+                    break
+                threading.Thread(target=self.handle, args=(connection,), daemon=True).start()
+        finally:
+            self.shutdown()
+
+    def shutdown(self):
+        self.listener.close()
+        if isinstance(self.address, str) and os.path.exists(self.address):
+            os.remove(self.address)
+        shutil.rmtree(self.directory, ignore_errors=True)
+
+
+class FieldClient:
+    '''
+    Stands in for a SubsetLoader, reading through a FieldServer. Slices come back as read-only
+    arrays memory-mapped from the server's shared memory, so every client shares one copy.
+    The client holds on to its last maxsize slices, older ones are released to the server,
+    which may then evict them. Arrays already handed out stay valid.
+    Parameters:
+    -----------
+    address - where the server listens
+    maxsize - slices held at once
+    '''
+    def __init__(self, address=ADDRESS, maxsize=64, authkey=None):
+        self.address = address
+        self.authkey = authkey or load_authkey()
+        self.maxsize = maxsize
+        self.connection = Client(address, authkey=self.authkey)
+        self.lock = threading.Lock()
+        self.held = OrderedDict()
+
+        info = self.request('info')
+        self.source = info['source']
+        self.run_time = info['run_time']
+        self.catalog = info['catalog']
+        self.lat, self.lon = [np.load(path, mmap_mode='r') for path in info['grid']]
+
+    def request(self, *message):
+        with self.lock:
+            self.connection.send(message)
+            reply = self.connection.recv()
+        if isinstance(reply, Exception):
+            raise reply
+        return reply
+
+    @property
+    def variables(self):
+        return self.catalog.variables
+
+    def steps(self, var):
+        '''
+        Number of timesteps and levels of var, levels is 1 for fields without a level dimension.
+        '''
+        from derived import DERIVED, is_derived
+        if is_derived(var, self.variables):
+            var = DERIVED[var].inputs[0]
+        shape = self.variables[var]['shape']
+        return shape[0], shape[1] if len(shape) > 3 else 1
+
+    def coordinates(self, window):
+        y0, y1, x0, x1 = window
+        return self.lon[y0:y1, x0:x1], self.lat[y0:y1, x0:x1]
+
+    def read(self, var, time=0, level=0, extent=None):
+        '''
+        Returns (values, lon, lat) of var inside extent like SubsetLoader.read, values is read-only.
+        '''
+        extent = None if extent is None else tuple(float(c) for c in extent)
+        key, path, window = self.request('read', var, time, level, extent)
+        values = np.load(path, mmap_mode='r')
+        with self.lock:
+            self.held[key] = self.held.get(key, 0) + 1
+            self.held.move_to_end(key)
+            released = []
+            while sum(self.held.values()) > self.maxsize:
+                old, count = self.held.popitem(last=False)
+                released += [old] * count
+            for old in released:
+                self.connection.send(('release', old))
+        lon, lat = self.coordinates(window)
+        return values, lon, lat
+
+    def wait_statistics(self):
+        '''
+        Block until the server has the field statistics and copy them into the catalog.
+        Uses its own connection, so reads on other threads are not held up meanwhile.
+        '''
+        connection = Client(self.address, authkey=self.authkey)
+        try:
+            connection.send(('statistics',))
+            stats = connection.recv()
+        finally:
+            connection.close()
+        if isinstance(stats, Exception):
+            raise stats
+        self.catalog.stats.update(stats)
+
+    def close(self):
+        #The server releases everything this client held when the connection goes
+        self.connection.close()
+
+
+def parse_address(address):
+    if address is None:
+        return ADDRESS
+    host, _, port = address.rpartition(':')
+    return (host, int(port)) if port.isdigit() and host else address
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Serve forecast slices to Diana sessions on this machine through shared memory.')
+    parser.add_argument('--source', default=MEPS_URL, help='OPeNDAP url or NetCDF file, default is the latest MEPS run')
+    parser.add_argument('--address', default=None, help='Unix socket path or host:port to listen on')
+    parser.add_argument('--max-mb', type=int, default=1024, help='shared memory kept for slices no session holds')
+    parser.add_argument('--allow-remote', action='store_true', help='allow a --address that is not loopback')
+    parser.add_argument('--statistics', action='store_true',
+                        help='compute min/max of every field in the background once for all sessions, reads the whole dataset')
+    args = parser.parse_args(argv)
+
+    server = FieldServer(args.source, parse_address(args.address), args.max_mb * 2**20, allow_remote=args.allow_remote,
+                         statistics=args.statistics)
+    #Stopped like an interrupt, so the socket and the shared memory are cleaned up
+    signal.signal(signal.SIGTERM, signal.default_int_handler)
+    print('Serving', args.source, 'on', server.address)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,250 @@
+from collections import OrderedDict
+from matplotlib.tri import Triangulation
+from scipy import sparse
+from timing import span
+from loader import ChunkCache
+import cartopy.crs as ccrs, numpy as np
+import hashlib, os, zipfile
+
+WEIGHTS_DIR = os.path.join(os.path.expanduser('~'), '.cache', 'diana', 'weights')
+
+
+def grid_key(lon, lat):
+    '''
+    Cheap identity of a lat/lon grid: shape plus the corner points, so two
+    reads of the same grid share a key without hashing the full arrays.
+    '''
+    lon, lat = np.asarray(lon), np.asarray(lat)
+    corners = [lon.flat[0], lon.flat[-1], lat.flat[0], lat.flat[-1]]
+    return lon.shape, tuple(float(c) for c in corners)
+
+
+class GridGeometry:
+    '''
+    Grid points projected once into the target projection and triangulated there.
+    Fields on the grid are gathered with take() and contoured without a transform.
+    Parameters:
+    -----------
+    lon, lat   - longitude and latitude of the grid points (any shape)
+    projection - cartopy projection of the map axes
+    extent     - [min_lon, max_lon, min_lat, max_lat], points well outside are dropped
+    margin     - degrees kept around the extent so contours reach the map edge
+    '''
+    def __init__(self, lon, lat, projection, extent=None, margin=1.0):
+        lon = np.asarray(lon, dtype=float).ravel()
+        lat = np.asarray(lat, dtype=float).ravel()
+        keep = np.isfinite(lon) & np.isfinite(lat)
+        if extent is not None:
+            min_lon, max_lon, min_lat, max_lat = extent
+            keep &= (lon >= min_lon - margin) & (lon <= max_lon + margin)
+            keep &= (lat >= min_lat - margin) & (lat <= max_lat + margin)
+
+        xyz = projection.transform_points(ccrs.Geodetic(), lon[keep], lat[keep])
+        finite = np.isfinite(xyz[:, 0]) & np.isfinite(xyz[:, 1])
+
+        self.size = lon.size
+        self.index = np.flatnonzero(keep)[finite]
+        self.x, self.y = xyz[finite, 0], xyz[finite, 1]
+        self.triangulation = Triangulation(self.x, self.y)
+
+    def take(self, values):
+        return np.asarray(values).ravel()[self.index]
+
+
+def interpolation_matrix(geometry, px, py):
+    '''
+    Sparse (points, grid) matrix of linear interpolation weights from a GridGeometry to the points
+    (px, py) in the same projection. Rows of points outside the grid are empty.
+    '''
+    tri = geometry.triangulation
+    found = tri.get_trifinder()(px, py)
+    inside = np.flatnonzero(found >= 0)
+    corners = tri.triangles[found[inside]]
+    x, y = tri.x[corners], tri.y[corners]
+    px, py = px[inside], py[inside]
+
+    #Barycentric coordinates of each point in its triangle
+    det = (y[:, 1] - y[:, 2]) * (x[:, 0] - x[:, 2]) + (x[:, 2] - x[:, 1]) * (y[:, 0] - y[:, 2])
+    l0 = ((y[:, 1] - y[:, 2]) * (px - x[:, 2]) + (x[:, 2] - x[:, 1]) * (py - y[:, 2])) / det
+    l1 = ((y[:, 2] - y[:, 0]) * (px - x[:, 2]) + (x[:, 0] - x[:, 2]) * (py - y[:, 2])) / det
+    weights = np.stack([l0, l1, 1 - l0 - l1], axis=1)
+
+    #Columns refer to the full grid, so the weights work without the geometry once stored
+    return sparse.csr_matrix((weights.ravel(), (np.repeat(inside, 3), geometry.index[corners.ravel()])),
+                             shape=(len(found), geometry.size))
+
+
+class RasterWeights:
+    '''
+    Sparse linear-interpolation weights from the points of a GridGeometry to a regular
+    grid of pixel centres in the same projection. A field is rasterised with one
+    sparse matrix-vector product, pixels outside the grid are NaN.
+    Parameters:
+    -----------
+    geometry - GridGeometry in the target projection
+    bounds   - (x0, x1, y0, y1) of the raster in projection coordinates
+    shape    - (ny, nx) pixels
+    '''
+    def __init__(self, geometry, bounds, shape, matrix=None):
+        self.bounds = tuple(bounds)
+        self.shape = tuple(shape)
+        self.matrix = self.interpolation_matrix(geometry, bounds, shape) if matrix is None else matrix
+        self.covered = np.asarray(self.matrix.sum(axis=1)).ravel() > 0
+
+    @staticmethod
+    def interpolation_matrix(geometry, bounds, shape):
+        x0, x1, y0, y1 = bounds
+        ny, nx = shape
+        #Pixel centres
+        px = x0 + (np.arange(nx) + 0.5) * (x1 - x0) / nx
+        py = y0 + (np.arange(ny) + 0.5) * (y1 - y0) / ny
+        px, py = [a.ravel() for a in np.meshgrid(px, py)]
+        return interpolation_matrix(geometry, px, py)
+
+    def regrid(self, values):
+        '''
+        Field on the source grid (any shape) to an (ny, nx) raster.
+        '''
+        raster = self.matrix @ np.asarray(values, dtype=float).ravel()
+        raster[~self.covered] = np.nan
+        return raster.reshape(self.shape)
+
+
+class GridWeights:
+    '''
+    Sparse linear-interpolation weights from one lat/lon grid to the points of another, e.g. a
+    WRF domain onto a second one. Fields are regridded with one sparse product, a stack of levels
+    with a single product, and target points outside the source grid are NaN.
+    Parameters:
+    -----------
+    geometry - GridGeometry of the source grid
+    lon, lat - target grid points, projected into the projection of the geometry
+    '''
+    def __init__(self, geometry, lon, lat, projection, matrix=None):
+        self.shape = np.shape(lon)
+        if matrix is None:
+            xyz = projection.transform_points(ccrs.Geodetic(), np.ravel(lon), np.ravel(lat))
+            matrix = interpolation_matrix(geometry, xyz[:, 0], xyz[:, 1])
+        self.matrix = matrix
+        self.covered = np.asarray(self.matrix.sum(axis=1)).ravel() > 0
+
+    def regrid(self, values):
+        '''
+        (..., ny, nx) field on the source grid to (..., *target shape).
+        '''
+        values = np.asarray(values, dtype=float)
+        stack = values.reshape(-1, self.matrix.shape[1])
+        regridded = (self.matrix @ stack.T).T
+        regridded[:, ~self.covered] = np.nan
+        return regridded.reshape(values.shape[:-2] + self.shape)
+
+
+class WeightsCache(ChunkCache):
+    '''
+    ChunkCache of sparse interpolation matrices, one .npz file per key, within the same byte budget.
+    '''
+    suffix = '.npz'
+
+    @staticmethod
+    def save(file, matrix):
+        sparse.save_npz(file, matrix)
+
+    @staticmethod
+    def load(path):
+        try:
+            return sparse.load_npz(path)
+        except zipfile.BadZipFile as error:
+            raise ValueError(f'{path} is not a weights file') from error
+
+
+class GeometryCache:
+    '''
+    Keeps GridGeometry objects keyed on (grid, projection, extent) so repeated
+    contour calls skip the projection and Delaunay triangulation of the grid.
+    Interpolation weights are also kept on disk in directory, least recently used first within max_bytes.
+    '''
+    def __init__(self, maxsize=8, directory=WEIGHTS_DIR, max_bytes=512 * 2**20):
+        self.maxsize = maxsize
+        self.entries = OrderedDict()
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self._disk = None
+
+    @property
+    def disk(self):
+        #Made on first use, most caches only ever triangulate
+        if self._disk is None:
+            self._disk = WeightsCache(self.directory, self.max_bytes)
+        return self._disk
+
+    def get(self, lon, lat, projection, extent=None):
+        key = (grid_key(lon, lat), projection, None if extent is None else tuple(extent))
+        if key in self.entries:
+            self.entries.move_to_end(key)
+            return self.entries[key]
+
+        with span('triangulate'):
+            geometry = GridGeometry(lon, lat, projection, extent)
+        self.entries[key] = geometry
+        while len(self.entries) > self.maxsize:
+            self.entries.popitem(last=False)
+        return geometry
+
+    def raster(self, lon, lat, projection, extent, bounds, shape):
+        '''
+        RasterWeights for the grid, kept in memory with the geometry and stored on disk
+        so a new session skips the point location as well.
+        '''
+        bounds = tuple(round(float(b), 3) for b in bounds)
+        key = (grid_key(lon, lat), projection, None if extent is None else tuple(extent), 'raster', bounds, tuple(shape))
+        if key in self.entries:
+            self.entries.move_to_end(key)
+            return self.entries[key]
+
+        lon, lat = np.asarray(lon, dtype=float), np.asarray(lat, dtype=float)
+        digest = hashlib.sha1(lon.tobytes() + lat.tobytes() + repr((projection.to_wkt(), key[2:])).encode()).hexdigest()
+        matrix = self.disk.get(digest)
+        if matrix is not None:
+            weights = RasterWeights(None, bounds, shape, matrix=matrix)
+        else:
+            geometry = self.get(lon, lat, projection, extent)
+            with span('raster_weights'):
+                weights = RasterWeights(geometry, bounds, shape)
+            self.disk.put(digest, weights.matrix)
+
+        self.entries[key] = weights
+        while len(self.entries) > self.maxsize:
+            self.entries.popitem(last=False)
+        return weights
+
+    def invalidate(self):
+        self.entries.clear()
+
+    def regrid(self, source_lon, source_lat, lon, lat):
+        '''
+        GridWeights from the source grid to the points lon, lat, stored on disk like the raster
+        weights. Points are located in a Lambert Conformal projection centred on the target grid.
+        '''
+        key = (grid_key(source_lon, source_lat), grid_key(lon, lat), 'regrid')
+        if key in self.entries:
+            self.entries.move_to_end(key)
+            return self.entries[key]
+
+        arrays = [np.asarray(a, dtype=float) for a in (source_lon, source_lat, lon, lat)]
+        digest = hashlib.sha1(b''.join(a.tobytes() for a in arrays) + b'regrid').hexdigest()
+        matrix = self.disk.get(digest)
+        if matrix is not None:
+            weights = GridWeights(None, lon, lat, None, matrix=matrix)
+        else:
+            extent = (float(np.nanmin(lon)), float(np.nanmax(lon)), float(np.nanmin(lat)), float(np.nanmax(lat)))
+            projection = ccrs.LambertConformal(central_longitude=(extent[0] + extent[1]) / 2,
+                                               central_latitude=(extent[2] + extent[3]) / 2)
+            geometry = self.get(source_lon, source_lat, projection, extent)
+            with span('regrid_weights'):
+                weights = GridWeights(geometry, lon, lat, projection)
+            self.disk.put(digest, weights.matrix)
+
+        self.entries[key] = weights
+        while len(self.entries) > self.maxsize:
+            self.entries.popitem(last=False)
+        return weights
@@ -0,0 +1,178 @@
+from collections import OrderedDict
+from timing import span
+from derived import DERIVED, is_derived
+import numpy as np, xarray as xr
+import hashlib, os, threading
+
+MEPS_URL = 'https://thredds.met.no/thredds/dodsC/mepslatest/meps_det_vc_2_5km_latest.nc'
+CACHE_DIR = os.path.join(os.path.expanduser('~'), '.cache', 'diana', 'chunks')
+
+
+class ChunkCache:
+    '''
+    On-disk cache of fetched slabs, one .npy file per key, evicted least recently
+    used first once the files take up more than max_bytes. Safe to share between reader threads.
+    Files are written under a temporary name and renamed, so other processes never load a partial file.
+    Subclasses store other kinds of arrays by overriding suffix, save and load.
+    '''
+    suffix = '.npy'
+
+    def __init__(self, directory=CACHE_DIR, max_bytes=512 * 2**20):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.lock = threading.Lock()
+        os.makedirs(directory, exist_ok=True)
+
+        #Rebuild the LRU order from modification times left by earlier sessions
+        files = [os.path.join(directory, name) for name in os.listdir(directory) if name.endswith(self.suffix)]
+        files.sort(key=os.path.getmtime)
+        self.files = OrderedDict((path, os.path.getsize(path)) for path in files)
+        self.size = sum(self.files.values())
+
+    def path(self, key):
+        return os.path.join(self.directory, hashlib.sha1(repr(key).encode()).hexdigest() + self.suffix)
+
+    def get(self, key):
+        with self.lock:
+            return self._get(key)
+
+    def put(self, key, array):
+        with self.lock:
+            self._put(key, array)
+
+    def _get(self, key):
+        path = self.path(key)
+        if path not in self.files:
+            return None
+        try:
+            array = self.load(path)
+        except (OSError, ValueError):
+            self.discard(path)
+            return None
+        os.utime(path)
+        self.files.move_to_end(path)
+        return array
+
+    def _put(self, key, array):
+        path = self.path(key)
+        self.discard(path)
+        part = f'{path}.{os.getpid()}.{threading.get_ident()}.part'
+        with open(part, 'wb') as f:
+            self.save(f, array)
+        os.replace(part, path)
+        self.files[path] = os.path.getsize(path)
+        self.size += self.files[path]
+        while self.size > self.max_bytes and len(self.files) > 1:
+            self.discard(next(iter(self.files)))
+
+    @staticmethod
+    def save(file, array):
+        np.save(file, np.ascontiguousarray(array))
+
+    @staticmethod
+    def load(path):
+        return np.load(path)
+
+    def discard(self, path):
+        size = self.files.pop(path, None)
+        if size is None:
+            return
+        self.size -= size
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+
+
+class SubsetLoader:
+    '''
+    Reads 2-D fields from a MEPS dataset (OPeNDAP url or local NetCDF path),
+    requesting only the index window that covers a lat/lon extent.
+    Parameters:
+    -----------
+    source - url or file path opened with xarray
+    cache  - ChunkCache for fetched slabs, None disables the disk cache
+    margin - grid cells added around the window so contours reach the map edge
+    '''
+    def __init__(self, source=MEPS_URL, cache=None, margin=2):
+        self.source = source
+        self.dataset = xr.open_dataset(source)
+        self.cache = cache
+        self.margin = margin
+        self.lat = np.asarray(self.dataset['latitude'].values)
+        self.lon = np.asarray(self.dataset['longitude'].values)
+        self.windows = {}
+
+        if 'forecast_reference_time' in self.dataset.variables:
+            self.run_time = str(self.dataset['forecast_reference_time'].values)
+        else:
+            self.run_time = str(source)
+
+    @property
+    def variables(self):
+        return self.dataset.variables
+
+    def window(self, extent=None):
+        '''
+        Index window (y0, y1, x0, x1) of the grid points inside extent = [min_lon, max_lon, min_lat, max_lat].
+        '''
+        ny, nx = self.lat.shape[-2:]
+        if extent is None:
+            return 0, ny, 0, nx
+        extent = tuple(float(c) for c in extent)
+        if extent in self.windows:
+            return self.windows[extent]
+
+        min_lon, max_lon, min_lat, max_lat = extent
+        inside = (self.lon >= min_lon) & (self.lon <= max_lon) & (self.lat >= min_lat) & (self.lat <= max_lat)
+        rows, cols = np.flatnonzero(inside.any(axis=1)), np.flatnonzero(inside.any(axis=0))
+        if len(rows) == 0:
+            window = 0, ny, 0, nx
+        else:
+            window = (max(rows[0] - self.margin, 0), min(rows[-1] + 1 + self.margin, ny),
+                      max(cols[0] - self.margin, 0), min(cols[-1] + 1 + self.margin, nx))
+        self.windows[extent] = tuple(int(i) for i in window)
+        return self.windows[extent]
+
+    def coordinates(self, window):
+        y0, y1, x0, x1 = window
+        return self.lon[y0:y1, x0:x1], self.lat[y0:y1, x0:x1]
+
+    def steps(self, var):
+        '''
+        Number of timesteps and levels of var, levels is 1 for fields without a level dimension.
+        '''
+        if is_derived(var, self.dataset.variables):
+            var = DERIVED[var].inputs[0]
+        shape = self.dataset[var].shape
+        return shape[0], shape[1] if len(shape) > 3 else 1
+
+    def indexer(self, var, time, level, window):
+        #First dimension is time, the last two are (y, x), the first of any others is the level
+        dims = self.dataset[var].dims
+        y0, y1, x0, x1 = window
+        index = {dims[0]: time, dims[-2]: slice(y0, y1), dims[-1]: slice(x0, x1)}
+        for i, dim in enumerate(dims[1:-2]):
+            index[dim] = level if i == 0 else 0
+        return index
+
+    def read(self, var, time=0, level=0, extent=None):
+        '''
+        Returns (values, lon, lat) of var inside extent, served from the disk cache when possible.
+        Derived variables are computed from their inputs read over the same slice.
+        '''
+        window = self.window(extent)
+        #Two sources can share a run time, e.g. a local copy and the OPeNDAP dataset, or MEPS and AROME
+        key = (self.source, self.run_time, var, time, level, window)
+        values = None if self.cache is None else self.cache.get(key)
+        if values is None and is_derived(var, self.dataset.variables):
+            values = DERIVED[var].evaluate(lambda name: self.read(name, time, level, extent)[0])
+            if self.cache is not None:
+                self.cache.put(key, values)
+        elif values is None:
+            with span('read', var=var, time=time, level=level):
+                values = np.asarray(self.dataset[var].isel(self.indexer(var, time, level, window)).values)
+            if self.cache is not None:
+                self.cache.put(key, values)
+        lon, lat = self.coordinates(window)
+        return values, lon, lat
@@ -0,0 +1,84 @@
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+import threading
+
+
+class Prefetcher:
+    '''
+    Loads slices through a SubsetLoader on a thread pool and keeps the results in a
+    bounded in-memory cache. Nothing here touches Tk, the GUI collects finished
+    slices with get() from a Window.after callback.
+    Parameters:
+    -----------
+    loader  - SubsetLoader used for the reads
+    radius  - number of timesteps before and after the current one to prefetch
+    workers - number of reader threads
+    maxsize - number of slices kept in memory
+    observe - function observe(var, time, level, values) called on the reader thread after each read
+    '''
+    def __init__(self, loader, radius=2, workers=2, maxsize=32, observe=None):
+        self.loader = loader
+        self.observe = observe
+        self.radius = radius
+        self.maxsize = maxsize
+        self.pool = ThreadPoolExecutor(max_workers=workers)
+        self.lock = threading.Lock()
+        self.slices = OrderedDict()
+        self.pending = {}
+
+    @staticmethod
+    def key(var, time, level, extent):
+        return var, time, level, None if extent is None else tuple(float(c) for c in extent)
+
+    def get(self, var, time, level, extent):
+        '''
+        Returns (values, lon, lat) if the slice is loaded, otherwise None.
+        Errors from the reader thread are raised here, on the caller's thread.
+        '''
+        key = self.key(var, time, level, extent)
+        with self.lock:
+            if key in self.slices:
+                self.slices.move_to_end(key)
+                return self.slices[key]
+            future = self.pending.get(key)
+        if future is not None and future.done() and future.exception() is not None:
+            with self.lock:
+                self.pending.pop(key, None)
+            raise future.exception()
+        return None
+
+    def load(self, var, time, level, extent):
+        key = self.key(var, time, level, extent)
+        with self.lock:
+            if key in self.slices or key in self.pending:
+                return
+            self.pending[key] = self.pool.submit(self.read, key)
+
+    def read(self, key):
+        var, time, level, extent = key
+        result = self.loader.read(var, time, level, extent)
+        if self.observe is not None:
+            self.observe(var, time, level, result[0])
+        with self.lock:
+            self.slices[key] = result
+            self.pending.pop(key, None)
+            while len(self.slices) > self.maxsize:
+                self.slices.popitem(last=False)
+        return result
+
+    def prefetch(self, var, time, level, extent):
+        '''
+        Queue the current slice first, then time +-1..radius and level +-1 around it.
+        '''
+        ntimes, nlevels = self.loader.steps(var)
+        self.load(var, time, level, extent)
+        for dt in range(1, self.radius + 1):
+            for t in (time + dt, time - dt):
+                if 0 <= t < ntimes:
+                    self.load(var, t, level, extent)
+        for h in (level + 1, level - 1):
+            if 0 <= h < nlevels:
+                self.load(var, time, h, extent)
+
+    def shutdown(self):
+        self.pool.shutdown(wait=False, cancel_futures=True)
@@ -1,9 +1,18 @@
+from functools import lru_cache
 import tkinter as tk
 
 
 def cp_projections():
     return ['AlbersEqualArea', 'AzimuthalEquidistant', 'EckertI', 'EckertII', 'EckertIII', 'EckertIV', 'EckertV', 'EckertVI', 'EqualEarth', 'EquidistantConic', 'EuroPP', 'Geostationary', 'Globe', 'Gnomonic', 'InterruptedGoodeHomolosine', 'LambertAzimuthalEqualArea', 'LambertConformal', 'LambertCylindrical', 'Mercator', 'Miller', 'Mollweide', 'NearsidePerspective', 'NorthPolarStereo', 'OSGB', 'OSNI', 'Orthographic', 'PlateCarree', 'Robinson', 'RotatedGeodetic', 'RotatedPole', 'Sinusoidal', 'SouthPolarStereo', 'Stereographic', 'TransverseMercator']
 
+@lru_cache(maxsize=None)
+def get_projection(name):
+    '''
+    Cartopy projection by name, instantiated once and shared afterwards.
+    '''
+    import cartopy.crs as ccrs
+    return getattr(ccrs, name)()
+
 def dropdown(Window, column, row, options):
     def show():
         myLabel = tk.Label(Window,  text=clicked.get()).pack()
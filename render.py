@@ -0,0 +1,89 @@
+from matplotlib.figure import Figure
+from matplotlib.backends.backend_agg import FigureCanvasAgg
+from matplotlib.colors import BoundaryNorm
+from matplotlib.ticker import MaxNLocator
+import cartopy.crs as ccrs, matplotlib, numpy as np
+
+
+def draw_field(map, geometry, values, levels=10, cmap='coolwarm', alpha=0.5):
+    '''
+    Filled contours of a field on a cached GridGeometry. Shared by the GUI and batch rendering.
+    '''
+    #Grid is triangulated once in map coordinates, so no transform is needed here
+    return map.tricontourf(geometry.triangulation, geometry.take(values), levels=levels, alpha=alpha, cmap=cmap)
+
+
+def draw_raster(map, raster, values, levels=10, cmap='coolwarm', alpha=0.5):
+    '''
+    Field rasterised with precomputed RasterWeights and drawn with imshow, coloured in
+    the same discrete levels filled contours would use.
+    '''
+    image = raster.regrid(values)
+    if np.ndim(levels) == 0:
+        levels = MaxNLocator(levels + 1).tick_values(np.nanmin(image), np.nanmax(image))
+    cmap = matplotlib.colormaps[cmap] if isinstance(cmap, str) else cmap
+    return map.imshow(image, extent=raster.bounds, origin='lower', transform=map.projection, interpolation='nearest',
+                      cmap=cmap, norm=BoundaryNorm(levels, cmap.N), alpha=alpha)
+
+
+def map_raster(map, geometry_cache, lon, lat, extent):
+    '''
+    RasterWeights with one pixel per screen pixel of the map axes.
+    '''
+    shape = (max(int(map.bbox.height), 1), max(int(map.bbox.width), 1))
+    return geometry_cache.raster(lon, lat, map.projection, extent, map.get_extent(), shape)
+
+
+def data_extent(lon, lat):
+    return [float(np.amin(lon)), float(np.amax(lon)), float(np.amin(lat)), float(np.amax(lat))]
+
+
+def visible_extent(map, samples=21, default=(-180, 180, -90, 90)):
+    '''
+    Lon/lat box covering everything visible in a map axes. In most projections this is larger
+    than the box given to set_extent, since its corners are visible too.
+    default is returned when no point of the view is inside the projection's domain.
+    '''
+    #An odd number of samples includes the centre row, where global maps reach +-180
+    x0, x1, y0, y1 = map.get_extent()
+    X, Y = np.meshgrid(np.linspace(x0, x1, samples), np.linspace(y0, y1, samples))
+    lonlat = ccrs.PlateCarree().transform_points(map.projection, X.ravel(), Y.ravel())
+    lon, lat = lonlat[:, 0], lonlat[:, 1]
+    finite = np.isfinite(lon) & np.isfinite(lat)
+    if not finite.any():
+        return None if default is None else list(default)
+    #Rounded outwards so small changes of the view keep the same cache keys
+    return [float(np.floor(lon[finite].min())), float(np.ceil(lon[finite].max())),
+            float(np.floor(lat[finite].min())), float(np.ceil(lat[finite].max()))]
+
+
+def render_map(loader, geometry_cache, var, time, level, projection, extent=None, levels=10, cmap='coolwarm',
+               size=(12, 8), coastlines=True, title=None, mode='contour'):
+    '''
+    Render one field to a new Agg figure without any display.
+    Parameters:
+    -----------
+    loader         - SubsetLoader of the dataset
+    geometry_cache - GeometryCache reused between calls
+    projection     - cartopy projection instance
+    extent         - [min_lon, max_lon, min_lat, max_lat], default is the extent of the data
+    mode           - 'contour' for filled contours or 'raster' for precomputed-weight imshow
+    '''
+    extent = data_extent(loader.lon, loader.lat) if extent is None else list(extent)
+
+    fig = Figure(figsize=size)
+    FigureCanvasAgg(fig)
+    map = fig.add_subplot(111, projection=projection)
+    map.set_extent(extent, crs=ccrs.PlateCarree())
+    if coastlines:
+        map.coastlines()
+
+    visible = visible_extent(map)
+    values, lon, lat = loader.read(var, time, level, visible)
+    if mode == 'raster':
+        contour = draw_raster(map, map_raster(map, geometry_cache, lon, lat, visible), values, levels, cmap)
+    else:
+        contour = draw_field(map, geometry_cache.get(lon, lat, projection, visible), values, levels, cmap)
+    fig.colorbar(contour, ax=map, orientation='horizontal', location='bottom')
+    map.set_title(f'{var} t={time} h={level}' if title is None else title)
+    return fig
@@ -0,0 +1,79 @@
+from scipy import sparse
+from geometry import GridGeometry, interpolation_matrix
+import cartopy.crs as ccrs, numpy as np
+
+EARTH_RADIUS = 6371.0
+
+
+def path_distance(lat, lon):
+    '''
+    Distance in km from the first point along a lat/lon polyline, great circle between the points.
+    '''
+    lat, lon = np.radians(lat), np.radians(lon)
+    a = np.sin(np.diff(lat) / 2)**2 + np.cos(lat[:-1]) * np.cos(lat[1:]) * np.sin(np.diff(lon) / 2)**2
+    return np.concatenate([[0], np.cumsum(2 * EARTH_RADIUS * np.arcsin(np.sqrt(a)))])
+
+
+def sample_path(path, npoints):
+    '''
+    npoints (lat, lon) evenly spaced by distance along the polyline path = [(lat, lon), ...].
+    '''
+    path = np.asarray(path, dtype=float).reshape(-1, 2)
+    distance = path_distance(path[:, 0], path[:, 1])
+    samples = np.linspace(0, distance[-1], npoints)
+    return np.interp(samples, distance, path[:, 0]), np.interp(samples, distance, path[:, 1]), samples
+
+
+def destagger(values, axis):
+    return 0.5 * (np.take(values, np.arange(values.shape[axis] - 1), axis) + np.take(values, np.arange(1, values.shape[axis]), axis))
+
+
+class SectionPath:
+    '''
+    Horizontal interpolation weights from a curvilinear grid to points along a lat/lon polyline,
+    computed once per path. Columns are restricted to the bounding box of grid points the path
+    touches, so each timestep only reads that box and the section is one sparse product
+    over the whole (z, y, x) slab.
+    Parameters:
+    -----------
+    lat, lon - grid points, (ny, nx)
+    path     - sequence of (lat, lon) vertices of the polyline
+    npoints  - points sampled evenly along the path
+    '''
+    def __init__(self, lat, lon, path, npoints=200):
+        self.path = tuple(map(tuple, np.asarray(path, dtype=float).reshape(-1, 2)))
+        self.lat, self.lon, self.distance = sample_path(self.path, npoints)
+        shape = np.shape(lat)
+
+        #Points are located in a projection centred on the path, only grid points near it are triangulated
+        extent = (self.lon.min(), self.lon.max(), self.lat.min(), self.lat.max())
+        projection = ccrs.LambertConformal(central_longitude=(extent[0] + extent[1]) / 2,
+                                           central_latitude=(extent[2] + extent[3]) / 2)
+        geometry = GridGeometry(lon, lat, projection, extent)
+        xyz = projection.transform_points(ccrs.Geodetic(), self.lon, self.lat)
+        matrix = interpolation_matrix(geometry, xyz[:, 0], xyz[:, 1]).tocoo()
+        self.covered = np.asarray(matrix.sum(axis=1)).ravel() > 0
+        if not self.covered.any():
+            raise ValueError('the path does not cross the grid')
+
+        y, x = np.unravel_index(matrix.col, shape)
+        self.box = (slice(int(y.min()), int(y.max()) + 1), slice(int(x.min()), int(x.max()) + 1))
+        self.box_shape = (self.box[0].stop - self.box[0].start, self.box[1].stop - self.box[1].start)
+        local = (y - self.box[0].start) * self.box_shape[1] + (x - self.box[1].start)
+        self.matrix = sparse.csr_matrix((matrix.data, (matrix.row, local)), shape=(npoints, self.box_shape[0] * self.box_shape[1]))
+
+    def key(self, time, staggered=(False, False)):
+        '''
+        (time, z, y, x) key of the bounding box, one point wider along staggered horizontal dimensions.
+        '''
+        return (time, slice(None)) + tuple(slice(b.start, b.stop + s) for b, s in zip(self.box, staggered))
+
+    def section(self, values):
+        '''
+        (..., y, x) values over the bounding box to (..., npoints), NaN where the path leaves the grid.
+        '''
+        values = np.asarray(values, dtype=float)
+        stack = values.reshape(-1, self.matrix.shape[1])
+        section = (self.matrix @ stack.T).T
+        section[:, ~self.covered] = np.nan
+        return section.reshape(values.shape[:-2] + (len(self.distance),))
@@ -0,0 +1,45 @@
+from scipy.spatial import cKDTree
+import numpy as np
+
+
+def to_xyz(lat, lon):
+    lat, lon = np.radians(lat), np.radians(lon)
+    return np.stack([np.cos(lat) * np.cos(lon), np.cos(lat) * np.sin(lon), np.sin(lat)], axis=-1)
+
+
+class StationIndex:
+    '''
+    KD-tree over a curvilinear lat/lon grid, built once, mapping station
+    coordinates to the (y, x) indices of the nearest grid points.
+    '''
+    def __init__(self, lat, lon):
+        lat, lon = np.asarray(lat), np.asarray(lon)
+        self.shape = lat.shape
+        self.tree = cKDTree(to_xyz(lat.ravel(), lon.ravel()))
+
+    def locate(self, stations):
+        '''
+        stations - sequence of (lat, lon) pairs, returns the arrays (y, x)
+        '''
+        stations = np.asarray(stations, dtype=float).reshape(-1, 2)
+        _, nearest = self.tree.query(to_xyz(stations[:, 0], stations[:, 1]))
+        return np.unravel_index(nearest, self.shape)
+
+
+def sliding_mean(values, window, step=1):
+    '''
+    Means of values over windows of `window` samples along axis 0, starting every `step` samples,
+    computed from one cumulative sum.
+    '''
+    total = np.cumsum(values, axis=0)
+    total = np.concatenate([np.zeros_like(total[:1]), total])
+    starts = np.arange(0, len(values) - window + 1, step)
+    return (total[starts + window] - total[starts]) / window
+
+
+def columns(read, y, x):
+    '''
+    read(y, x) at each station's grid point, stacked along a last station axis. Each read is
+    one column, so nothing between distant stations is read.
+    '''
+    return np.stack([np.asarray(read(int(j), int(i))) for j, i in zip(y, x)], axis=-1)
@@ -0,0 +1,70 @@
+from matplotlib.figure import Figure
+from matplotlib.backends.backend_agg import FigureCanvasAgg
+from geometry import GeometryCache
+from features import FeatureCache, draw_coastlines
+from render import draw_raster, visible_extent
+import cartopy.crs as ccrs
+
+
+class PlotTemplate:
+    '''
+    Figure, Lambert Conformal map, coastlines and extent built once and reused for
+    every frame. Only the contour set, colorbar and title are replaced in draw().
+    Parameters:
+    -----------
+    extent  - [min_lon, max_lon, min_lat, max_lat] of the map
+    figsize - figure size in inches
+    ncols   - maps side by side, sharing the extent and the colorbar
+    '''
+    def __init__(self, extent, figsize=(10, 10), ncols=1):
+        min_lon, max_lon, min_lat, max_lat = extent
+        self.extent = extent
+        self.projection = ccrs.LambertConformal(central_latitude=(
+            min_lat + max_lat)/2, central_longitude=(max_lon + min_lon)/2)
+        self.PC = ccrs.PlateCarree()
+
+        self.fig = Figure(figsize=figsize)
+        FigureCanvasAgg(self.fig)
+        #Projected coastlines come from the disk cache in every worker process after the first
+        self.features = FeatureCache()
+        self.maps = []
+        for i in range(ncols):
+            map = self.fig.add_subplot(1, ncols, i + 1, projection=self.projection)
+            map.set_extent(extent, crs=self.PC)
+            draw_coastlines(map, self.features, visible_extent(map))
+            self.maps.append(map)
+        self.map = self.maps[0]
+        self.plots = [None] * ncols
+        self.cax = None
+        self.geometry = GeometryCache()
+
+    def draw(self, lon, lat, values, levels=None, title='', mode='contour', cmap=None):
+        '''
+        mode - 'contour' for filled contours or 'raster' for an image from precomputed interpolation weights
+        '''
+        return self.draw_maps([(lon, lat, values)], levels, [title], mode, cmap)
+
+    def draw_maps(self, fields, levels=None, titles=None, mode='contour', cmap=None):
+        '''
+        One (lon, lat, values) per map, each on its own grid. Pass levels so the maps share the colorbar.
+        '''
+        levels = 10 if levels is None else levels
+        for i, (lon, lat, values) in enumerate(fields):
+            map = self.maps[i]
+            if self.plots[i] is not None:
+                self.plots[i].remove()
+            if mode == 'raster':
+                shape = (int(map.bbox.height), int(map.bbox.width))
+                raster = self.geometry.raster(lon, lat, self.projection, self.extent, map.get_extent(), shape)
+                self.plots[i] = draw_raster(map, raster, values, levels, cmap or 'viridis', alpha=1)
+            else:
+                self.plots[i] = map.contourf(lon, lat, values, levels, transform=self.PC, cmap=cmap)
+            map.set_title('' if titles is None else titles[i])
+
+        #The colorbar axes is made on the first frame and redrawn in place afterwards
+        if self.cax is None:
+            self.cax = self.fig.colorbar(self.plots[0], ax=self.maps, orientation='horizontal').ax
+        else:
+            self.cax.clear()
+            self.fig.colorbar(self.plots[0], cax=self.cax, orientation='horizontal')
+        return self.fig
@@ -3,62 +3,142 @@ import cartopy.crs as ccrs
 import cartopy as cp
 import io, projections, numpy as np
 import tkinter as tk
-import PIL
 import matplotlib.pyplot as plt
 import xarray as xr
 
 import numpy as np
 import matplotlib.pyplot as plt
 import cartopy as cp
-import os
 from netCDF4 import Dataset
-from PIL import Image
+from animation import render_frames, save_animation
+from template import PlotTemplate
+from diagnostics import Diagnostics
+from stations import StationIndex, sliding_mean, columns
+from timing import span
+from catalog import open_catalog
+from derived import DERIVED, available, is_derived
+from comparison import open_comparison
+from sections import SectionPath, destagger
+from matplotlib.ticker import MaxNLocator
 
 plotpath = "/nird/projects/NS9600K/brittsc/WRF_output_Stian/plots/"
+andoya_extent = (6.97, 32.33, 75.5, 81.2)
+#West to east across the middle of the Andoya map, as (lat, lon) vertices
+andoya_section = ((78.35, 6.97), (78.35, 32.33))
+
+#Outputs opened by unpickling, so every frame a worker process renders reuses one dataset and its plot templates
+_opened = {}
+
+
+def open_output(output_file, plotpath, chunks=None):
+    key = (output_file, plotpath, repr(chunks))
+    if key not in _opened:
+        _opened[key] = WRF_Output(output_file, plotpath, chunks)
+    return _opened[key]
 
 
 class WRF_Output:
-    def __init__(self, output_file, plotpath):
+    def __init__(self, output_file, plotpath, chunks=None):
+        '''
+        chunks - None reads with netCDF4, {} reads through xarray/dask with the file's
+                 on-disk chunking, 'auto' or a dict of chunk sizes is passed on to xarray
+        '''
+        self.output_file = output_file
+        self.chunks = chunks
         self.data = Dataset(output_file)
+        #Out-of-core backend: slices are dask arrays, reductions stream chunk by chunk on all cores
+        self.chunked = None if chunks is None else xr.open_dataset(output_file, chunks=chunks)
         self.plotpath = plotpath
         self.lat = self.data.variables['XLAT'][1, :, :]
         self.lon = lon = self.data.variables['XLONG'][1, :, :]
         self.R = 287
         self.date, self.start_hour = self.data.variables['XTIME'].units[
             14:24], self.data.variables['XTIME'].units[25:27]
+        self.domain_extent = (float(np.amin(self.lon)), float(np.amax(self.lon)),
+                              float(np.amin(self.lat)), float(np.amax(self.lat)))
+        self.templates = {}
+        self.diag = Diagnostics(self.read, self.R)
+        self._station_index = None
+        self._catalog = None
+        self.sections = {}
+
+    def __reduce__(self):
+        #Worker processes reopen the file instead of pickling the netCDF handle
+        return open_output, (self.output_file, self.plotpath, self.chunks)
+
+    def template(self, only_andoya=True, figsize=(10, 10)):
+        extent = andoya_extent if only_andoya else self.domain_extent
+        if (extent, figsize) not in self.templates:
+            self.templates[extent, figsize] = PlotTemplate(extent, figsize)
+        return self.templates[extent, figsize]
+
+    @property
+    def station_index(self):
+        if self._station_index is None:
+            self._station_index = StationIndex(self.lat, self.lon)
+        return self._station_index
+
+    @property
+    def catalog(self):
+        #Metadata is read from the sidecar when the file is unchanged, statistics are added per variable on demand
+        if self._catalog is None:
+            self._catalog, self.catalog_path = open_catalog(self.data, self.output_file, stats=False)
+        return self._catalog
+
+    def contour_levels(self, var, n=10, times=None, levels=None):
+        '''
+        n contour levels spanning var over the given timesteps and levels (default all), from the catalog.
+        None for derived variables, which have no statistics.
+        '''
+        if is_derived(var, self.data.variables):
+            return None
+        self.catalog.add_statistics(self.data, [var], self.catalog_path)
+        return self.catalog.contour_levels(var, n, times, levels)
+
+    @property
+    def fields(self):
+        #Mappable raw variables followed by the derived ones that can be computed from them
+        return self.catalog.fields() + available(self.data.variables)
+
+    def shape(self, var):
+        #Derived variables have the shape of their first input
+        if is_derived(var, self.data.variables):
+            var = DERIVED[var].inputs[0]
+        return self.data.variables[var].shape
+
+    def read(self, var, key):
+        '''
+        var[key] as a NumPy array, or a lazy dask array when the file was opened with chunks.
+        Derived variables read their inputs at key only and are memoized.
+        '''
+        if is_derived(var, self.data.variables):
+            return self.diag.cached(var, key, lambda: DERIVED[var].evaluate(lambda name: self.diag.source(name, key)))
+        if self.chunked is not None:
+            return self.chunked[var].data[key]
+        return np.ma.filled(self.data.variables[var][key], np.nan)
+
+    def mean(self, var, key, axis=0):
+        '''
+        Mean of var[key] along axis, streamed chunk by chunk with the chunked backend.
+        '''
+        return np.asarray(self.read(var, key).mean(axis))
 
     def pressure(self, time, loc):
-        return self.data.variables['PB'][time, :, loc[0], loc[1]] + self.data.variables['P'][time, :, loc[0], loc[1]]
+        return self.diag.pressure(time, slice(None), loc[0], loc[1])
 
     def temperature(self, time, loc):
-        theta = 300 + self.data.variables['T'][time, :, loc[0], loc[1]]
-        return theta * (self.pressure(time, loc) / 1000) ** (2 / 7)
-
-    def write_variables_to_file(self, file):
-        with open('variables.txt', 'w') as f:
-            for var, name in zip(self.data.variables.values(), self.data.variables.keys()):
-                try:
-                    des = str(var.description)
-                except AttributeError:
-                    des = ' '
-                try:
-                    dim = str(var.dimensions)
-                except AttributeError:
-                    dim = ' '
-                try:
-                    shp = str(var.shape)
-                except AttributeError:
-                    shp = ' '
-                try:
-                    unit = str(var.units)
-                except AttributeError:
-                    unit = ' '
-                f.write(f'{name:22s}{unit:20s}{dim:60s}{shp:20s}{des:85s}')
-                f.write('\n')
-                f.write(u'\u2500' * 205)
-                f.write('\n')
-
-    def area_plot(self, var, start_time, height=0, only_andoya=True, levels=None, title='map.png', end_time=None, loc=None):
+        return self.diag.temperature(time, slice(None), loc[0], loc[1])
+
+    def compare(self, other, labels=None):
+        '''
+        Comparison of other regridded onto this run, for difference, ratio, bias and paired plots and animations.
+        '''
+        return open_comparison(self, other, labels)
+
+    def write_variables_to_file(self, file='variables.txt'):
+        self.catalog.write_listing(file)
+
+    def area_plot(self, var, start_time, height=0, only_andoya=True, levels=None, title='map.png', end_time=None, loc=None, savefig=True, mode='contour'):
         '''
         Plot horizontal map using Lambert Conformal projection of WRF simulation over Andoya.
         Parameters:
@@ -69,136 +149,233 @@ class WRF_Output:
         height      - model altitude level to plot at, default is 0
         only_andoya - whether to plot full model area or only Andoya specifically, default True
         levels - specify min/max range and number of bins for colorbar (tuple), default is None
+        savefig     - save the figure to plotpath + title, otherwise only return it
+        mode        - 'contour' for filled contours, 'raster' for an image from precomputed interpolation weights
         '''
 
-        if only_andoya:
-            min_lat = 75.5
-            max_lat = 81.2
-            min_lon = 6.97
-            max_lon = 32.33
+        with span('area_plot', var=var, time=start_time, height=height):
+            #Figure, projection, coastlines and extent are reused between calls, only the data is redrawn
+            template = self.template(only_andoya)
+
+            with span('read'):
+                if len(self.shape(var)) == 3:
+                    field = np.asarray(self.read(var, (start_time, slice(None), slice(None))))
+                if len(self.shape(var)) == 4:
+                    field = np.asarray(self.read(var, (start_time, height, slice(None), slice(None))))
+
+            #Find and set date and time as title
+            hour = int(self.start_hour) + start_time
+            with span('draw'):
+                fig = template.draw(self.lon, self.lat, field, levels, self.date + ' ' + str(hour) + ':00:00 ' +
+                                    var + ' height=' + str(height), mode)
+            if savefig:
+                with span('savefig'):
+                    fig.savefig(plotpath + title)
+        return fig
+
+    def number_conc_profiles(self, var, stations, start_time=0, end_time=None, binsize=2, step_interval=1, per_liter=False):
+        '''
+        Time-averaged vertical profiles of var for several stations and sliding time windows.
+        Parameters:
+        -----------
+        var           - 4 dimensional variable to average
+        stations      - sequence of (lat, lon) pairs, mapped to the nearest grid point
+        start_time    - first timestep of the first window
+        end_time      - first timestep of the last window, default is the last window that fits
+        binsize       - each window covers start to start + binsize, inclusive
+        step_interval - timesteps between the starts of consecutive windows
+        per_liter     - convert to per litre with the air density at each timestep
+        Returns an xarray Dataset with var and height over (window, z, station).
+        '''
+        y, x = self.station_index.locate(stations)
+        times = slice(start_time, self.shape(var)[0] if end_time is None else end_time + binsize + 1)
 
-        else:
-            min_lat = np.amin(self.lat)
-            max_lat = np.amax(self.lat)
-            min_lon = np.amin(self.lon)
-            max_lon = np.amax(self.lon)
-
-        #Create map instance
-        proj = cp.crs.LambertConformal(central_latitude=(
-            min_lat + max_lat)/2, central_longitude=(max_lon + min_lon)/2)
-
-        PC = cp.crs.PlateCarree()
-        fig = plt.figure(figsize=(10, 10))
-        map = fig.add_subplot(projection=proj)
-        map.coastlines()
-        map.set_extent([min_lon, max_lon, min_lat, max_lat], crs=PC)
-
-        if len(self.data.variables[var].shape) == 3:
-            if levels is not None:
-                plot = map.contourf(
-                    self.lon, self.lat, self.data.variables[var][start_time, :, :], 10, transform=PC, levels=levels)
-            else:
-                plot = map.contourf(
-                    self.lon, self.lat, self.data.variables[var][start_time, :, :], 10, transform=PC)
-
-        if len(self.data.variables[var].shape) == 4:
-            if levels is not None:
-                plot = map.contourf(
-                    self.lon, self.lat, self.data.variables[var][start_time, height, :, :], 10, transform=PC, levels=levels)
-            else:
-                plot = map.contourf(
-                    self.lon, self.lat, self.data.variables[var][start_time, height, :, :], 10, transform=PC)
-
-        #Find and set date and time as title
-        hour = int(self.start_hour) + start_time
-        plt.title(self.date + ' ' + str(hour) + ':00:00 ' +
-                  var + ' height=' + str(height))
-        plt.colorbar(plot, orientation='horizontal')
-        plt.savefig(plotpath + title)
-
-    def number_conc_profile(self, var, start_time, end_time, loc=(78.9, 11.9), only_andoya=True, levels=None, title=None, height=None, per_liter=False):
-        lat, lon = loc
-        mid_time = int((start_time + end_time) / 2)
-        PH = self.data.variables["PH"][mid_time, :, lat, lon]
-        PHB = self.data.variables["PHB"][mid_time, :, lat, lon]
-        H = (PH + PHB) / 9.81
-        NC = np.mean(
-            self.data.variables[var][start_time: end_time + 1, :, lat, lon], 0)
+        #One (time, z) column per station, stations far apart would otherwise span most of the domain
+        NC = columns(lambda j, i: self.diag.source(var, (times, slice(None), j, i)), y, x)
         unit = 'm$^{-3}$'
-
         if per_liter:
-            density = self.pressure(start_time, loc) / \
-                (self.R * self.temperature(start_time, loc))
-            NC = NC * density / 1000
+            NC = NC * columns(lambda j, i: self.diag.density(times, slice(None), j, i), y, x) / 1000
             unit = 'L$^{-1}$'
+        NC = np.asarray(sliding_mean(NC, binsize + 1, step_interval))
+
+        starts = start_time + step_interval * np.arange(len(NC))
+        H = columns(lambda j, i: self.diag.height(times, slice(None), j, i), y, x)[starts - start_time + binsize // 2]
+
+        stations = np.asarray(stations, dtype=float).reshape(-1, 2)
+        return xr.Dataset({var: (('window', 'z', 'station'), NC), 'height': (('window', 'z', 'station'), H)},
+                          coords={'start_time': ('window', starts), 'end_time': ('window', starts + binsize),
+                                  'station_lat': ('station', stations[:, 0]), 'station_lon': ('station', stations[:, 1])},
+                          attrs={'var': var, 'unit': unit})
+
+    def number_conc_profile(self, var, start_time, end_time, loc=(78.9, 11.9), only_andoya=True, levels=None, title=None, height=None, per_liter=False, savefig=True):
+        '''
+        Profile of var averaged from start_time to end_time at loc = (lat, lon).
+        '''
+        profiles = self.number_conc_profiles(var, [loc], start_time, start_time, end_time - start_time, per_liter=per_liter)
+        return self.profile_plot(profiles.isel(window=0), title, savefig)
+
+    def profile_plot(self, profile, title=None, savefig=True):
+        var, unit = profile.attrs['var'], profile.attrs['unit']
 
         # Create the figure and add axes
         fig = plt.figure(figsize=(12, 8))
         ax = fig.add_axes([0.1, 0.1, 0.8, 0.8])
-        ax.plot(NC, H[1:])
+        for s in range(profile.sizes['station']):
+            station = profile.isel(station=s)
+            ax.plot(station[var], station['height'],
+                    label=f"{float(station['station_lat']):.2f}N {float(station['station_lon']):.2f}E")
+        if profile.sizes['station'] > 1:
+            ax.legend()
 
-        start_hour = start_time + 12
-        end_hour = end_time + 12
+        start_hour = int(profile['start_time']) + 12
+        end_hour = int(profile['end_time']) + 12
 
         ax.set_title(self.date + ' ' + str(start_hour) +
                      ':00-' + str(end_hour) + ':00 ' + var)
         ax.set_xlabel(f'number concentration [{unit}]')
         ax.set_ylabel('Altitude [m]')
+        if not savefig:
+            return fig
         if title is None:
             plt.savefig(plotpath + var + '_' + self.date + '_' +
                         str(start_hour) + '-' + str(end_hour) + '.png')
         else:
             plt.savefig(plotpath + title)
+        return fig
 
-    def time_animation(self, var, plotter, height=0, loc=(78.9, 11.9), step_interval=1, n_frames=37, binsize=2, anim_title='animation', duration=200, levels=None):
-        frames = []
-        for frame in range(n_frames):
-            frame_name = f'{frame}.png'
-            t = frame * step_interval
-            plotter(var, height=height, start_time=t, end_time=t+binsize,
-                    loc=loc, only_andoya=True, levels=levels, title=frame_name)
-            frames.append(Image.open(self.plotpath + frame_name))
-            plt.close()
-            os.remove(plotpath + frame_name)
-
-        frames[0].save(plotpath + anim_title + '.gif', format='GIF',
-                       append_images=frames[1:], save_all=True, duration=duration, loop=1)
-
-    def create_animation(self, var, time=0, height=0, only_andoya=True, levels=None, time_plot=True):
-        #Create pngs by calling plot method
-        frames = []
+    def time_animation(self, var, plotter, height=0, loc=(78.9, 11.9), step_interval=1, n_frames=37, binsize=2, anim_title='animation', duration=200, levels=None, workers=None, fmt='gif', stations=None, per_liter=False):
+        '''
+        Animate plotter over time. Frames are rendered in parallel and kept in memory,
+        fmt is 'gif', or 'mp4'/'webm' when ffmpeg is available.
+        Profiles are extracted for all stations (default [loc]) in one read before rendering.
+        '''
+        if plotter == self.number_conc_profile:
+            profiles = self.number_conc_profiles(var, [loc] if stations is None else stations, 0,
+                                                 (n_frames - 1) * step_interval, binsize, step_interval, per_liter)
+            plotter = self.profile_plot
+            frames = [dict(profile=profiles.isel(window=frame)) for frame in range(profiles.sizes['window'])]
+        else:
+            if levels is None and plotter == self.area_plot:
+                levels = self.contour_levels(var, levels=height)
+            frames = [dict(var=var, height=height, start_time=frame * step_interval, end_time=frame * step_interval + binsize,
+                           loc=loc, only_andoya=True, levels=levels) for frame in range(n_frames)]
+        save_animation(render_frames(plotter, frames, workers), self.plotpath + anim_title + '.' + fmt,
+                       duration=duration, loop=1)
+
+    def create_animation(self, var, time=0, height=0, only_andoya=True, levels=None, time_plot=True, n_frames=None, workers=None, fmt='gif', mode='contour'):
+        #Frames are rendered by a process pool and streamed into the writer in order.
+        #Contour levels come from the catalog, so they do not jump between frames
         if time_plot:
-            for t in range(37):
-                frame_name = f'{t}.png'
-                self.area_plot(var, t, height, only_andoya,
-                               levels, title=frame_name)
-                frames.append(Image.open(plotpath + frame_name))
-                plt.close()
-                os.remove(plotpath + frame_name)
-                title = f'{var}_time_animation.gif'
+            levels = self.contour_levels(var, levels=height) if levels is None else levels
+            n_frames = 37 if n_frames is None else n_frames
+            frames = [dict(var=var, start_time=t, height=height, only_andoya=only_andoya, levels=levels, mode=mode)
+                      for t in range(n_frames)]
+            title = f'{var}_time_animation.{fmt}'
         else:
             #create height animation
-            for h in range(57):
-                frame_name = f'{h}.png'
-                self.area_plot(var, time, 3*h, only_andoya,
-                               levels, title=frame_name)
-                frames.append(Image.open(plotpath + frame_name))
-                plt.close()
-                os.remove(plotpath + frame_name)
-                title = f'{var}_height_animation.gif'
+            n_frames = 57 if n_frames is None else n_frames
+            levels = self.contour_levels(var, times=time) if levels is None else levels
+            frames = [dict(var=var, start_time=time, height=3*h, only_andoya=only_andoya, levels=levels, mode=mode)
+                      for h in range(n_frames)]
+            title = f'{var}_height_animation.{fmt}'
+
+        save_animation(render_frames(self.area_plot, frames, workers), self.plotpath + title, duration=200, loop=0)
 
-        frames[0].save(plotpath + title, format='GIF',
-                       append_images=frames[1:], save_all=True, duration=200, loop=0)
+    def section_path(self, path, npoints=200):
+        '''
+        Weights along path and the destaggered height on it, computed once per path.
+        The height is taken at the first timestep, PH varies little compared with PHB.
+        '''
+        key = (tuple(map(tuple, np.asarray(path, dtype=float).reshape(-1, 2))), npoints)
+        if key not in self.sections:
+            section = SectionPath(self.lat, self.lon, path, npoints)
+            height = section.section(np.asarray(self.diag.height(0, slice(None), *section.box)))
+            self.sections[key] = section, height
+        return self.sections[key]
+
+    def cross_sections(self, var, path=andoya_section, times=0, npoints=200):
+        '''
+        Vertical sections of var along a lat/lon polyline.
+        Parameters:
+        -----------
+        var     - 4 dimensional variable, staggered dimensions are averaged to the mass points
+        path    - sequence of (lat, lon) vertices
+        times   - timestep or sequence of timesteps, each is one read of the bounding box of the path
+        npoints - points sampled evenly along the path
+        Returns an xarray Dataset with var over (time, z, point) and height over (z, point).
+        '''
+        section, height = self.section_path(path, npoints)
+        if len(self.shape(var)) != 4:
+            raise ValueError(f'{var} has no vertical dimension')
+        dims = self.data.variables[DERIVED[var].inputs[0] if is_derived(var, self.data.variables) else var].dimensions
+        staggered = ('south_north_stag' in dims, 'west_east_stag' in dims)
+
+        times = np.atleast_1d(times)
+        values = []
+        for time in times:
+            with span('read', var=var, time=int(time)):
+                slab = np.asarray(self.read(var, section.key(int(time), staggered)), dtype=float)
+            for axis, stag in zip((-2, -1), staggered):
+                if stag:
+                    slab = destagger(slab, axis)
+            if 'bottom_top_stag' in dims:
+                slab = destagger(slab, 0)
+            values.append(section.section(slab))
+
+        units = DERIVED[var].units if is_derived(var, self.data.variables) else self.catalog.variables[var]['units']
+        return xr.Dataset({var: (('time', 'z', 'point'), np.stack(values)), 'height': (('z', 'point'), height)},
+                          coords={'time': times, 'distance': ('point', section.distance),
+                                  'lat': ('point', section.lat), 'lon': ('point', section.lon)},
+                          attrs={'var': var, 'unit': units or ''})
+
+    def cross_section(self, var, time=0, path=andoya_section, npoints=200, levels=None, title=None, savefig=True):
+        '''
+        Vertical section of var along path = [(lat, lon), ...] at one timestep.
+        '''
+        return self.section_plot(self.cross_sections(var, path, time, npoints).isel(time=0), levels, title, savefig)
+
+    def section_plot(self, section, levels=None, title=None, savefig=True):
+        var, unit = section.attrs['var'], section.attrs['unit']
+        distance = np.broadcast_to(section['distance'].values, section['height'].shape)
+
+        fig = plt.figure(figsize=(12, 6))
+        ax = fig.add_axes([0.1, 0.1, 0.75, 0.8])
+        plot = ax.contourf(distance, section['height'].values, section[var].values, 10 if levels is None else levels)
+        fig.colorbar(plot, cax=fig.add_axes([0.88, 0.1, 0.02, 0.8]), label=f'{var} [{unit}]')
+
+        hour = int(self.start_hour) + int(section['time'])
+        ax.set_title(self.date + ' ' + str(hour) + ':00:00 ' + var + ' from ' +
+                     f"{float(section['lat'][0]):.2f}N {float(section['lon'][0]):.2f}E to "
+                     f"{float(section['lat'][-1]):.2f}N {float(section['lon'][-1]):.2f}E")
+        ax.set_xlabel('Distance along section [km]')
+        ax.set_ylabel('Altitude [m]')
+        if savefig:
+            fig.savefig(self.plotpath + (f'{var}_section_{int(section["time"])}.png' if title is None else title))
+        return fig
 
-    def cross_section(self, var, time=0):
-        pass
+    def section_animation(self, var, path=andoya_section, times=None, npoints=200, levels=None, workers=None, fmt='gif', anim_title=None, duration=200):
+        '''
+        Sections of var along path over time (default every timestep), extracted in this process with one
+        bounding-box read per timestep and rendered in parallel with the same levels in every frame.
+        '''
+        times = range(self.shape(var)[0]) if times is None else times
+        sections = self.cross_sections(var, path, times, npoints)
+        if levels is None:
+            values = sections[var].values
+            levels = MaxNLocator(11).tick_values(np.nanmin(values), np.nanmax(values))
+        frames = [dict(section=sections.isel(time=t), levels=levels) for t in range(sections.sizes['time'])]
+        title = f'{var}_section_animation' if anim_title is None else anim_title
+        save_animation(render_frames(self.section_plot, frames, workers), self.plotpath + title + '.' + fmt,
+                       duration=duration, loop=0)
 
 
 milbrandt_output_file = '/nird/projects/NS9600K/brittsc/WRF_output_Stian/Milbrandt/wrfout_d01_2019-11-11_12:00:00'
 morrison_output_file = '/nird/projects/NS9600K/brittsc/WRF_output_Stian/Morrison/wrfout_d02_2019-11-11_12:00:00'
 
-Milbrandt = WRF_Output(milbrandt_output_file, plotpath)
-Morrison = WRF_Output(morrison_output_file, plotpath)
+if __name__ == '__main__':
+    Milbrandt = WRF_Output(milbrandt_output_file, plotpath)
+    Morrison = WRF_Output(morrison_output_file, plotpath)
+    #Milbrandt.compare(Morrison).create_animation('QNICE', height=10, kind='difference')
 
 
 #area_plot(wrf_output_file, 'SST', 30, height=100, only_andoya=False, levels=np.linspace(260, 280, 30))
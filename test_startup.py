@@ -0,0 +1,42 @@
+import json, os, subprocess, sys, tkinter as tk
+import pytest
+from diana import STARTUP_TARGET
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+#Modules that take seconds to import, diana loads them on a thread once the window is up
+HEAVY = ('matplotlib', 'cartopy', 'xarray')
+#Importing diana is only part of the time before the window is shown
+IMPORT_TARGET = STARTUP_TARGET / 2
+
+IMPORT_DIANA = f'''
+import json, sys, time
+sys.path.insert(0, {HERE!r})
+start = time.perf_counter()
+import diana
+print(json.dumps({{'seconds': time.perf_counter() - start, 'heavy': [m for m in {HEAVY!r} if m in sys.modules]}}))
+'''
+
+
+def display_available():
+    try:
+        tk.Tk().destroy()
+    except tk.TclError:
+        return False
+    return True
+
+
+def test_import_is_light():
+    #A fresh interpreter, so nothing is imported yet. Runs without a display
+    result = subprocess.run([sys.executable, '-c', IMPORT_DIANA], capture_output=True, text=True, timeout=60)
+    assert result.returncode == 0, result.stderr
+    imported = json.loads(result.stdout.splitlines()[-1])
+    assert imported['heavy'] == [], f"import diana loaded {imported['heavy']}"
+    assert imported['seconds'] < IMPORT_TARGET, f"import diana took {imported['seconds']:.2f} s, target {IMPORT_TARGET:.2f} s"
+
+
+@pytest.mark.skipif(not display_available(), reason='no display to open a window on')
+def test_window_shown_within_target():
+    #A fresh interpreter, so the heavy imports are timed from a cold start
+    result = subprocess.run([sys.executable, os.path.join(HERE, 'diana.py'), '--startup-check'],
+                            capture_output=True, text=True, timeout=120)
+    assert result.returncode == 0, f'window not shown within {STARTUP_TARGET} s\n{result.stdout}{result.stderr}'
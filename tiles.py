@@ -0,0 +1,232 @@
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from matplotlib.figure import Figure
+from matplotlib.backends.backend_agg import FigureCanvasAgg
+from matplotlib.cm import ScalarMappable
+from matplotlib.colors import BoundaryNorm
+from matplotlib.ticker import MaxNLocator
+from geometry import GeometryCache
+from loader import ChunkCache
+from render import data_extent, draw_field, visible_extent
+from timing import span
+import matplotlib, numpy as np, math, os, threading
+
+TILE_SIZE = 256
+MAX_ZOOM = 12
+TILES_DIR = os.path.join(os.path.expanduser('~'), '.cache', 'diana', 'tiles')
+
+
+class TileCache:
+    '''
+    Rendered RGBA tiles kept least recently used first in memory, backed by a larger
+    on-disk ChunkCache. Each has its own byte budget.
+    '''
+    def __init__(self, memory_bytes=256 * 2**20, disk_bytes=2**30, directory=TILES_DIR):
+        self.memory_bytes = memory_bytes
+        self.memory = OrderedDict()
+        self.size = 0
+        self.disk = ChunkCache(directory, disk_bytes)
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        with self.lock:
+            if key in self.memory:
+                self.memory.move_to_end(key)
+                return self.memory[key]
+        tile = self.disk.get(key)
+        if tile is not None:
+            self.remember(key, tile)
+        return tile
+
+    def put(self, key, tile):
+        self.remember(key, tile)
+        self.disk.put(key, tile)
+
+    def remember(self, key, tile):
+        with self.lock:
+            if key in self.memory:
+                return
+            self.memory[key] = tile
+            self.size += tile.nbytes
+            while self.size > self.memory_bytes and len(self.memory) > 1:
+                _, old = self.memory.popitem(last=False)
+                self.size -= old.nbytes
+
+
+def tile_bounds(projection, zoom, i, j):
+    '''
+    (x0, x1, y0, y1) of tile column i, row j (counted from the top) at zoom, where the
+    projection's domain is split into 2**zoom by 2**zoom tiles.
+    '''
+    (X0, X1), (Y0, Y1) = projection.x_limits, projection.y_limits
+    width, height = (X1 - X0) / 2**zoom, (Y1 - Y0) / 2**zoom
+    return X0 + i * width, X0 + (i + 1) * width, Y1 - (j + 1) * height, Y1 - j * height
+
+
+def zoom_for_view(projection, view, pixels):
+    '''
+    Lowest zoom whose tiles have at least as many pixels as the screen over the view.
+    '''
+    (X0, X1), _ = projection.x_limits, projection.y_limits
+    ratio = (X1 - X0) * pixels / (TILE_SIZE * max(view[1] - view[0], 1e-9))
+    return min(max(math.ceil(math.log2(max(ratio, 1))), 0), MAX_ZOOM)
+
+
+def overlaps(a, b):
+    #Two [min_lon, max_lon, min_lat, max_lat] boxes
+    return a[0] <= b[1] and b[0] <= a[1] and a[2] <= b[3] and b[2] <= a[3]
+
+
+def tile_levels(values, n=10):
+    '''
+    n contour levels over a slice, for when no range of the field is known yet.
+    '''
+    finite = np.asarray(values)[np.isfinite(values)]
+    if len(finite) == 0:
+        return np.linspace(0, 1, n + 1)
+    return MaxNLocator(n + 1).tick_values(finite.min(), finite.max())
+
+
+def tiles_for_view(projection, view, zoom):
+    (X0, X1), (Y0, Y1) = projection.x_limits, projection.y_limits
+    n = 2**zoom
+    width, height = (X1 - X0) / n, (Y1 - Y0) / n
+    x0, x1, y0, y1 = view
+    columns = range(max(int((x0 - X0) // width), 0), min(int((x1 - X0) // width) + 1, n))
+    rows = range(max(int((Y1 - y1) // height), 0), min(int((Y1 - y0) // height) + 1, n))
+    return [(i, j) for j in rows for i in columns]
+
+
+class TileLayer:
+    '''
+    Field shown on a map as cached tiles. Tiles covering the view are taken from the
+    TileCache, missing ones are rendered on worker threads and placed by poll(), which
+    the GUI calls from its own thread.
+    Parameters:
+    -----------
+    map      - GeoAxes the tiles are drawn on
+    loader   - SubsetLoader of the dataset
+    proj     - name of the map projection, part of the tile keys
+    cache    - TileCache shared between layers
+    '''
+    def __init__(self, map, loader, proj, cache, workers=4):
+        self.map = map
+        self.loader = loader
+        self.proj = proj
+        self.cache = cache
+        self.pool = ThreadPoolExecutor(max_workers=workers)
+        self.local = threading.local()
+        self.artists = {}
+        self.pending = {}
+        self.field = None
+        self.extent = data_extent(loader.lon, loader.lat)
+
+    def show(self, var, time, level, cmap, levels):
+        '''
+        Start showing a field. levels must be a sequence, the same for every tile so tiles rendered
+        at different times line up. Nothing is read here, this runs on the GUI thread.
+        '''
+        self.field = (var, self.loader.source, self.loader.run_time, time, level, self.proj, cmap, tuple(float(l) for l in levels))
+        self.clear()
+        self.refresh()
+
+    @property
+    def mappable(self):
+        var, _, _, _, _, _, cmap, levels = self.field
+        cmap = matplotlib.colormaps[cmap]
+        return ScalarMappable(BoundaryNorm(levels, cmap.N), cmap)
+
+    def refresh(self):
+        '''
+        Place cached tiles for the current view and queue the missing ones.
+        '''
+        if self.field is None:
+            return
+        projection = self.map.projection
+        view = self.map.get_extent()
+        zoom = zoom_for_view(projection, view, self.map.bbox.width)
+        wanted = {self.field + (zoom, i, j) for i, j in tiles_for_view(projection, view, zoom)}
+
+        for key in list(self.artists):
+            if key not in wanted:
+                self.artists.pop(key).remove()
+        for key in wanted - set(self.artists):
+            tile = self.cache.get(key)
+            if tile is not None:
+                self.place(key, tile)
+            elif key not in self.pending:
+                self.pending[key] = self.pool.submit(self.render, key)
+
+    def poll(self):
+        '''
+        Place tiles finished since the last call, returns True if any were added.
+        '''
+        added = False
+        for key, future in list(self.pending.items()):
+            if not future.done():
+                continue
+            del self.pending[key]
+            if key[:len(self.field)] == self.field and future.exception() is None:
+                self.place(key, future.result())
+                added = True
+        return added
+
+    def place(self, key, tile):
+        if key in self.artists:
+            return
+        x0, x1, y0, y1 = tile_bounds(self.map.projection, *key[-3:])
+        #imshow would otherwise autoscale the map to the tile
+        limits = self.map.get_xlim(), self.map.get_ylim()
+        self.artists[key] = self.map.imshow(tile, extent=(x0, x1, y0, y1), origin='upper', transform=self.map.projection,
+                                            interpolation='nearest', zorder=1)
+        self.map.set_xlim(limits[0], emit=False)
+        self.map.set_ylim(limits[1], emit=False)
+
+    def render(self, key):
+        var, _, _, time, level, _, cmap, levels, zoom, i, j = key
+        with span('tile', zoom=zoom, i=i, j=j):
+            tile = self.render_tile(var, time, level, cmap, levels, zoom, i, j)
+        self.cache.put(key, tile)
+        return tile
+
+    def render_tile(self, var, time, level, cmap, levels, zoom, i, j):
+        x0, x1, y0, y1 = tile_bounds(self.map.projection, zoom, i, j)
+
+        fig = Figure(figsize=(1, 1), dpi=TILE_SIZE)
+        FigureCanvasAgg(fig)
+        fig.patch.set_alpha(0)
+        ax = fig.add_axes([0, 0, 1, 1], projection=self.map.projection)
+        ax.set_axis_off()
+        ax.set_aspect('auto')
+        ax.set_xlim(x0, x1)
+        ax.set_ylim(y0, y1)
+
+        #Each worker thread keeps its own geometry cache
+        if not hasattr(self.local, 'geometry'):
+            self.local.geometry = GeometryCache()
+        #Tiles outside the projection's domain or away from the data are cached as empty without a read
+        extent = visible_extent(ax, default=None)
+        if extent is not None and overlaps(extent, self.extent):
+            values, lon, lat = self.loader.read(var, time, level, extent)
+            try:
+                geometry = self.local.geometry.get(lon, lat, self.map.projection, extent)
+            except ValueError:
+                #Too few grid points on the tile to triangulate
+                geometry = None
+            if geometry is not None:
+                draw_field(ax, geometry, values, list(levels), cmap)
+
+        fig.canvas.draw()
+        return np.array(fig.canvas.buffer_rgba())
+
+    def clear(self):
+        for artist in self.artists.values():
+            artist.remove()
+        self.artists = {}
+        for future in self.pending.values():
+            future.cancel()
+        self.pending = {}
+
+    def shutdown(self):
+        self.clear()
+        self.pool.shutdown(wait=False, cancel_futures=True)
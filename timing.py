@@ -0,0 +1,121 @@
+'''
+Timing spans for finding where a render spends its time.
+
+    from timing import tracer, span
+    tracer.enable(profile=True)
+    with span('read', var=var):
+        ...
+    tracer.save('trace.json')          #open in chrome://tracing or ui.perfetto.dev
+    tracer.save_profile('render.prof') #cProfile stats of the enabling thread
+
+Worker processes started with the parent's origin record on the same time axis, and their
+drained events are merged into the parent's trace.
+
+While disabled, span() hands back one shared no-op context manager, so the spans can stay
+in place in the hot paths.
+'''
+from collections import deque
+from contextlib import nullcontext
+import cProfile, json, os, threading, time
+
+NOSPAN = nullcontext()
+
+
+class Span:
+    __slots__ = ('tracer', 'name', 'args', 'start')
+
+    def __init__(self, tracer, name, args):
+        self.tracer = tracer
+        self.name = name
+        self.args = args
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.tracer.record(self.name, self.start, time.perf_counter(), self.args)
+
+
+class Tracer:
+    '''
+    Collects finished spans as Chrome trace events and keeps the last duration of each span name.
+    Parameters:
+    -----------
+    maxevents - events kept, the oldest are dropped first
+    '''
+    def __init__(self, maxevents=100000):
+        self.enabled = False
+        self.events = deque(maxlen=maxevents)
+        self.last = {}
+        self.origin = time.perf_counter()
+        self.profiler = None
+
+    def enable(self, profile=False):
+        self.enabled = True
+        if profile and self.profiler is None:
+            self.profiler = cProfile.Profile()
+            self.profiler.enable()
+
+    def disable(self):
+        self.enabled = False
+        if self.profiler is not None:
+            self.profiler.disable()
+
+    def span(self, name, **args):
+        if not self.enabled:
+            return NOSPAN
+        return Span(self, name, args)
+
+    def wrap(self, name, function):
+        '''
+        function timed as a span on every call while tracing is enabled.
+        '''
+        def traced(*args, **kwargs):
+            if not self.enabled:
+                return function(*args, **kwargs)
+            with Span(self, name, None):
+                return function(*args, **kwargs)
+        return traced
+
+    def record(self, name, start, end, args):
+        event = {'name': name, 'ph': 'X', 'ts': (start - self.origin) * 1e6, 'dur': (end - start) * 1e6,
+                 'pid': os.getpid(), 'tid': threading.get_ident()}
+        if args:
+            event['args'] = {key: str(value) for key, value in args.items()}
+        #deque.append and dict assignment are atomic, spans may end on any thread
+        self.events.append(event)
+        self.last[name] = end - start
+
+    def drain(self):
+        '''
+        Remove and return the events recorded so far, e.g. to send them from a worker process.
+        '''
+        events = []
+        while self.events:
+            events.append(self.events.popleft())
+        return events
+
+    def merge(self, events):
+        #Events of another process, recorded against the same origin
+        self.events.extend(events)
+
+    def summary(self, names):
+        '''
+        Last duration of each of names that has run, as 'name 12 ms | ...'.
+        '''
+        return ' | '.join(f'{name} {self.last[name] * 1000:.0f} ms' for name in names if name in self.last)
+
+    def save(self, path):
+        with open(path, 'w') as f:
+            json.dump({'traceEvents': list(self.events), 'displayTimeUnit': 'ms'}, f)
+
+    def save_profile(self, path):
+        if self.profiler is None:
+            raise RuntimeError('profiling was not enabled')
+        self.profiler.create_stats()
+        self.profiler.dump_stats(path)
+
+
+tracer = Tracer()
+span = tracer.span